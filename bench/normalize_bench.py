@@ -0,0 +1,75 @@
+# Normalizes a synthetic RUZ student search response with and without the memoized transliteration
+# of src/lms_data_loader.py. Needs no DB or network, run from the repo root:
+#     python3 -m bench.normalize_bench --persons 100000
+
+import argparse
+import copy
+import random
+import time
+
+import src.lms_data_loader as lms_data_loader
+from src.lms_data_loader import LmsStudentLoader
+
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов', 'Новиков',
+              'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов', 'Козлов',
+              'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров', 'Зайцев', 'Соловьёв',
+              'Борисов', 'Яковлев', 'Григорьев', 'Романов', 'Воробьёв', 'Сергеев', 'Кузьмин', 'Фролов', 'Токмаков']
+FIRST_NAMES = ['Александр', 'Дмитрий', 'Максим', 'Сергей', 'Андрей', 'Алексей', 'Артём', 'Илья', 'Кирилл',
+               'Михаил', 'Никита', 'Матвей', 'Роман', 'Егор', 'Арсений', 'Иван', 'Денис', 'Евгений', 'Даниил',
+               'Анастасия', 'Мария', 'Дарья', 'Анна', 'Елизавета', 'Полина', 'Виктория', 'Екатерина', 'Софья']
+PATRONYMICS = ['Александрович', 'Дмитриевич', 'Сергеевич', 'Андреевич', 'Алексеевич', 'Михайлович', 'Иванович',
+               'Владимирович', 'Николаевич', 'Евгеньевич', 'Александровна', 'Дмитриевна', 'Сергеевна',
+               'Андреевна', 'Алексеевна', 'Михайловна', 'Ивановна', 'Владимировна', 'Николаевна']
+
+
+def synthetic_response(persons, last_names, seed):
+    # Real crawls have few distinct first names and patronymics and more distinct last names,
+    # last_names controls how many of them there are (suffixes on top of the list above)
+    rnd = random.Random(seed)
+    surnames = [LAST_NAMES[i % len(LAST_NAMES)] + ('' if i < len(LAST_NAMES) else '-' + LAST_NAMES[i % 7])
+                + ('' if i < 7 * len(LAST_NAMES) else str(i)) for i in range(last_names)]
+    return [{'id': 100000 + i,
+             'label': f"{rnd.choice(surnames)} {rnd.choice(FIRST_NAMES)} {rnd.choice(PATRONYMICS)}",
+             'description': f"БПИ{rnd.randint(150, 229)}",
+             'type': 'student'}
+            for i in range(persons)]
+
+
+def run(loader, response):
+    objs = copy.deepcopy(response)
+    start = time.perf_counter()
+    loader.normalize_objs(objs)
+    return time.perf_counter() - start, objs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--persons', type=int, default=100000)
+    parser.add_argument('--last-names', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    response = synthetic_response(args.persons, args.last_names, args.seed)
+    loader = LmsStudentLoader()
+
+    memoized = lms_data_loader.translit
+    lms_data_loader.translit = memoized.__wrapped__
+    try:
+        plain, plain_objs = run(loader, response)
+    finally:
+        lms_data_loader.translit = memoized
+
+    memoized.cache_clear()
+    cold, cached_objs = run(loader, response)
+    warm, _ = run(loader, response)
+    assert plain_objs == cached_objs
+
+    print(f"{args.persons} persons, {args.last_names} last names")
+    print(f"    plain: {plain:.2f} s, {args.persons / plain:.0f} persons/s")
+    print(f"memo cold: {cold:.2f} s, {args.persons / cold:.0f} persons/s")
+    print(f"memo warm: {warm:.2f} s, {args.persons / warm:.0f} persons/s")
+    print(f" translit: {memoized.cache_info()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Measures how long ./server.py takes to accept the first connection and to finish warming up
+# (DB connected, catalog loaded). Run from the repo root:
+#     python3 -m bench.startup_bench --runs 5
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def request(sock, obj):
+    bdata = json.dumps(obj).encode()
+    sock.sendall(len(bdata).to_bytes(4, byteorder='big') + bdata)
+    size = int.from_bytes(recvall(sock, 4), byteorder='big')
+    return json.loads(recvall(sock, size).decode())
+
+
+def recvall(sock, size):
+    bdata = bytes()
+    while len(bdata) < size:
+        chunk = sock.recv(size - len(bdata))
+        if len(chunk) == 0:
+            raise ConnectionResetError('Server closed connection')
+        bdata += chunk
+    return bdata
+
+
+def run_once(port, timeout):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, 'server.py', '--port', str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if timeout < time.perf_counter() - start:
+                raise TimeoutError('Server did not start')
+            try:
+                sock = socket.create_connection(('localhost', port), timeout=timeout)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.001)
+        accepted = time.perf_counter() - start
+
+        while True:
+            if timeout < time.perf_counter() - start:
+                raise TimeoutError('Server did not warm up')
+            res = request(sock, {'method': 'get_stats'})
+            if res['status'] == 'ok' and res['data']['ready']:
+                break
+            time.sleep(0.005)
+        ready = time.perf_counter() - start
+        sock.close()
+        return accepted, ready
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=13370)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    if not os.path.isfile('server.py'):
+        print('Run from the repo root')
+        return 1
+    results = [run_once(args.port + i, args.timeout) for i in range(args.runs)]
+    for i, (accepted, ready) in enumerate(results):
+        print(f"run {i}: accepting after {accepted * 1000:.1f} ms, ready after {ready * 1000:.1f} ms")
+    accepted = sorted(r[0] for r in results)[len(results) // 2]
+    ready = sorted(r[1] for r in results)[len(results) // 2]
+    print(f"median: accepting after {accepted * 1000:.1f} ms, ready after {ready * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# Compares get_timetable_by_user_id() joins with narrow lesson rows enriched from the in-memory catalog
+# and with precomputed contingent_timetable rows. Needs a filled DB (see bulk_import.py), run from the repo root:
+#     python3 -m bench.timetable_bench --users 200 --days 28
+
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from src.catalog import Catalog
+from src.server_backend import Server, dbconnect
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000 for p in (50, 90, 99)}
+
+
+def report(name, samples, rows):
+    p = percentiles(samples)
+    print(f"{name:>10}: p50 {p[50]:.2f} ms, p90 {p[90]:.2f} ms, p99 {p[99]:.2f} ms, {rows} rows total")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--days', type=int, default=28)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--refresh', action='store_true', help='rebuild contingent_timetable for all lessons first')
+    args = parser.parse_args()
+
+    db = dbconnect()
+    if args.refresh:
+        start = time.perf_counter()
+        db.query("""select refresh_contingent_timetable(array(select id from contingents),
+                                                        '-infinity', 'infinity')""")
+        print(f"contingent_timetable refreshed in {time.perf_counter() - start:.1f} s")
+    users = [row[0] for row in db.query(f"""select distinct student_id from students_to_contingents
+                                           limit {args.users}""").getresult()]
+    if len(users) == 0:
+        print('No students with contingents in DB')
+        return
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    catalog = Catalog()
+    catalog.load(db)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    catalog_bytes = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f"catalog: {catalog.size()}, {catalog_bytes / 1024:.1f} KiB")
+
+    time_start = datetime.now() - timedelta(days=args.days // 2)
+    time_end = datetime.now() + timedelta(days=args.days // 2)
+
+    joined, narrow, denormalized = [], [], []
+    joined_rows = narrow_rows = denormalized_rows = 0
+    for _ in range(args.rounds):
+        for user_id in users:
+            start = time.perf_counter()
+            rows = db.query(f"""select * from get_timetable_by_user_id({user_id}) timetable
+                                where timetable.date between '{time_start}' and '{time_end}'""").dictresult()
+            joined.append(time.perf_counter() - start)
+            joined_rows += len(rows)
+
+            start = time.perf_counter()
+            query = Server._timetable_query(user_id, time_start, time_end)
+            rows = catalog.enrich_lessons(db, db.query(query).dictresult())
+            narrow.append(time.perf_counter() - start)
+            narrow_rows += len(rows)
+
+            start = time.perf_counter()
+            query = Server._contingent_timetable_query(user_id, time_start, time_end)
+            rows = db.query(query).dictresult()
+            denormalized.append(time.perf_counter() - start)
+            denormalized_rows += len(rows)
+
+    report('sql joins', joined, joined_rows)
+    report('catalog', narrow, narrow_rows)
+    report('denorm', denormalized, denormalized_rows)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3.6
+
+import logging
+import sys
+
+from src.bulk_import import main
+
+FORMAT = "[%(funcName)s() @ %(filename)s:%(lineno)d] %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.WARNING)
+
+if __name__ == '__main__':
+    sys.exit(main())
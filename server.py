@@ -1,9 +1,11 @@
 #!/usr/bin/env python3.6
 
+import argparse
 import logging
 
 from src import settings
 from src.server_frontend_tcp import TCPServer
+from src.server_prefork import Supervisor
 
 FORMAT = "[%(funcName)s() @ %(filename)s:%(lineno)d] %(message)s"
 logger = logging.getLogger(settings.logger_name)
@@ -12,10 +14,20 @@ logging.getLogger("server").setLevel(logging.ERROR)
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=settings.server_addr['host'])
+    parser.add_argument('--port', type=int, default=settings.server_addr['port'])
+    parser.add_argument('--workers', type=int, default=settings.prefork['workers'],
+                        help='number of worker processes, 1 runs everything in this process')
+    args = parser.parse_args()
+
     logger.info("Starting up")
-    logger.info(f"Address: {settings.server_addr['host']}:{settings.server_addr['port']}")
+    logger.info(f"Address: {args.host}:{args.port}")
 
-    s = TCPServer(settings.server_addr['host'], settings.server_addr['port'])
+    if args.workers <= 1:
+        s = TCPServer(args.host, args.port)
+    else:
+        s = Supervisor(args.host, args.port, args.workers)
     s.run()
 
     logger.info("Exiting")
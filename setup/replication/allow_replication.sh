@@ -0,0 +1,3 @@
+#!/usr/bin/env bash
+# Runs once when the primary's data directory is created: lets the replica container stream WAL
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
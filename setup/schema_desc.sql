@@ -186,6 +186,32 @@ create table lesson
 
 alter table lesson owner to postgres;
 
+create table contingent_timetable
+(
+	contingent_id bigint not null
+		constraint contingent_timetable_contingents_id_fk
+			references contingents
+				on update cascade on delete cascade,
+	date date not null,
+	lesson_id bigint not null
+		constraint contingent_timetable_lesson_id_fk
+			references lesson
+				on update cascade on delete cascade,
+	lesson_time_id bigint not null,
+	start time not null,
+	"end" time not null,
+	building_addr text,
+	lesson_type varchar(255),
+	flow varchar(255),
+	course_short_name varchar(255),
+	course_full_name text,
+	primary key (contingent_id, date, lesson_id)
+);
+
+comment on table contingent_timetable is 'get_timetable_by_user_id() rows per contingent, kept by refresh_contingent_timetable()';
+
+alter table contingent_timetable owner to postgres;
+
 create table students_to_contingents
 (
 	student_id bigint not null
@@ -222,6 +248,18 @@ create unique index logins_id_uindex
 
 alter table logins owner to postgres;
 
+create table revoked_session_tokens
+(
+	token varchar(255) not null
+		constraint revoked_session_tokens_pk
+			primary key,
+	expires timestamp with time zone not null
+);
+
+comment on table revoked_session_tokens is 'Session tokens of users who logged out, rows are useless after expires';
+
+alter table revoked_session_tokens owner to postgres;
+
 create or replace function find_users(_first_name character varying, _last_name character varying, _patronymic_name character varying) returns SETOF students
   language plpgsql
 as
@@ -329,6 +367,46 @@ alter function get_timetable_by_user_id(bigint) owner to postgres;
 
 
 
+create or replace function refresh_contingent_timetable(_contingent_ids bigint[], _date_start date, _date_end date) returns void
+  language plpgsql
+as
+$$
+begin
+  delete from contingent_timetable
+  where contingent_id = any(_contingent_ids)
+    and date between _date_start and _date_end;
+  insert into contingent_timetable
+  select lessons.contingent_id        as "contingent_id",
+         lessons.date                 as "date",
+         lessons.id                   as "lesson_id",
+         lessons.lesson_time_id       as "lesson_time_id",
+         lesson_time.time_start       as "start",
+         lesson_time.time_end         as "end",
+         buildings.addr               as "building_addr",
+         lessons.lesson_type          as "lesson_type",
+         contingents.contingent_name  as "flow",
+         curses.shortname             as "course_short_name",
+         curses.fullname              as "course_full_name"
+  from lesson lessons
+         join contingents contingents on lessons.contingent_id = contingents.id
+         join learning_courses curses on lessons.course_id = curses.id
+         join auditoriums auditoriums on lessons.auditorium_id = auditoriums.id
+         join buildings buildings on auditoriums.building_id = buildings.id
+         join lesson_time lesson_time on lessons.lesson_time_id = lesson_time.id
+  where lessons.contingent_id = any(_contingent_ids)
+    and lessons.date between _date_start and _date_end
+  -- Concurrent refresh of the same contingent may have inserted the row already
+  on conflict (contingent_id, date, lesson_id) do update
+    set lesson_time_id = excluded.lesson_time_id, start = excluded.start, "end" = excluded."end",
+        building_addr = excluded.building_addr, lesson_type = excluded.lesson_type, flow = excluded.flow,
+        course_short_name = excluded.course_short_name, course_full_name = excluded.course_full_name;
+end
+$$;
+
+alter function refresh_contingent_timetable(bigint[], date, date) owner to postgres;
+
+
+
 create or replace function insert_deadline(_user_id bigint, _contingent_id bigint, _deadline_time timestamp without time zone, _weight double precision, _name character varying, _description text) returns void
   language plpgsql
 as
@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class Rejected(Exception):
+    # Request was not executed because of overload protection, the client may retry later
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    # One token bucket per key (user id or client ip). Buckets of keys that have not been seen
+    # for a while are full anyway, so the least recently used ones are dropped above max_keys.
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key, cost=1):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+                while self.max_keys < len(self.buckets):
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.take(cost)
+
+
+class WorkQueue:
+    # Fixed pool of worker threads behind a bounded queue. When the queue is full new work is
+    # shed right away instead of waiting, so the queueing delay of accepted requests stays bounded.
+
+    def __init__(self, workers, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, name=f'worker-{i}')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        future = Future()
+        try:
+            self.queue.put_nowait((future, func, args))
+        except queue.Full:
+            raise Rejected('Server is overloaded, try again later')
+        return future
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, func, args = item
+            # False if the request was cancelled while waiting in the queue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def stop(self):
+        for _ in self.threads:
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                break
@@ -0,0 +1,345 @@
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import src.invalidation
+import src.lms_data_loader
+import src.server_backend
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+# Snapshot layout: <dir>/<kind>/term_<quoted term>.json for searches and
+# <dir>/lessons/<student_id>_<begin>_<end>.json for timetables, every file is a raw RUZ response
+reference_kinds = ['buildings', 'auditoriums', 'teachers', 'students']
+state_file = 'import_state.json'
+
+
+class Progress:
+    def __init__(self, label, total=None):
+        self.label = label
+        self.total = total
+        self.done = 0
+
+    def step(self, n=1):
+        self.done += n
+        total = '' if self.total is None else f"/{self.total}"
+        print(f"\r{self.label}: {self.done}{total}", end='', file=sys.stderr)
+        sys.stderr.flush()
+
+    def finish(self):
+        self.step(0)
+        print(file=sys.stderr)
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+
+    def dir(self, kind):
+        path = os.path.join(self.path, kind)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def term_file(self, kind, term):
+        return os.path.join(self.dir(kind), 'term_' + quote(term, safe='') + '.json')
+
+    def lessons_file(self, student_id, begin, end):
+        return os.path.join(self.dir('lessons'), f"{student_id}_{begin:%Y%m%d}_{end:%Y%m%d}.json")
+
+    def files(self, kind):
+        path = self.dir(kind)
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.json'))
+
+    def read(self, path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def write(self, path, data):
+        # Files appear atomically, so an interrupted crawl never leaves a half written response behind
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def load_state(self):
+        path = os.path.join(self.path, state_file)
+        if not os.path.isfile(path):
+            return {'done': []}
+        return self.read(path)
+
+    def save_state(self, state):
+        self.write(os.path.join(self.path, state_file), state)
+
+
+def make_loaders():
+    building_loader = src.lms_data_loader.LmsBuildingLoader()
+    loaders = {
+        'buildings': building_loader,
+        'auditoriums': src.lms_data_loader.LmsAuditoriumLoader(building_loader),
+        'teachers': src.lms_data_loader.LmsTeacherLoader(),
+        'students': src.lms_data_loader.LmsStudentLoader(),
+    }
+    loaders['lessons'] = src.lms_data_loader.LmsLessonLoader(loaders['auditoriums'], loaders['teachers'])
+    return loaders
+
+
+def crawl_tree(snapshot, kind, loader, executor):
+    # Same prefix walk as LmsDataLoader.load_all_tree, one level at a time so that a level is fetched in parallel.
+    # Terms that are already in the snapshot are read from disk, this is what makes the crawl resumable.
+    progress = Progress(f"crawl {kind}")
+
+    def fetch(term):
+        path = snapshot.term_file(kind, term)
+        if os.path.isfile(path):
+            return snapshot.read(path)
+        objs = loader.fetch_term(term)
+        snapshot.write(path, objs)
+        return objs
+
+    level = ['']
+    depth = 0
+    while len(level) != 0 and depth <= loader.max_depth:
+        next_level = []
+        for term, objs in zip(level, executor.map(fetch, level)):
+            progress.step()
+            if src.lms_data_loader.LmsDataLoader.answ_len <= len(objs):
+                next_level += [term + c for c in loader.alphabet]
+        level = next_level
+        depth += 1
+    progress.finish()
+
+
+def crawl_lessons(snapshot, loader, student_ids, begin, end, executor):
+    progress = Progress('crawl lessons', len(student_ids))
+
+    def fetch(student_id):
+        path = snapshot.lessons_file(student_id, begin, end)
+        if not os.path.isfile(path):
+            snapshot.write(path, loader.fetch_lessons(student_id, begin, end))
+
+    for _ in executor.map(fetch, student_ids):
+        progress.step()
+    progress.finish()
+
+
+def snapshot_objects(snapshot, kind, loader):
+    objs = {}
+    for path in snapshot.files(kind):
+        for obj in snapshot.read(path):
+            objs[obj['id']] = obj
+    loader.normalize_objs(list(objs.values()))
+    return objs
+
+
+def copy_rows(db, table, columns, rows, key=('id',), update=True):
+    # COPY into a temporary table and merge from there, plain COPY can't upsert
+    if len(rows) == 0:
+        return 0
+    staging = f"import_{table}"
+    db.query(f"create temp table {staging} on commit drop as select {', '.join(columns)} from {table} with no data")
+    db.inserttable(staging, [tuple(row[c] for c in columns) for row in rows])
+    if update and len(columns) != len(key):
+        updates = ', '.join(f"{c} = excluded.{c}" for c in columns if c not in key)
+        conflict = f"on conflict ({', '.join(key)}) do update set {updates}"
+    else:
+        conflict = "on conflict do nothing"
+    db.query(f"""insert into {table} ({', '.join(columns)})
+                 select distinct on ({', '.join(key)}) {', '.join(columns)} from {staging} {conflict}""")
+    return len(rows)
+
+
+def copy_lessons(db, rows):
+    # lesson has a surrogate key only, so duplicates are filtered by their natural key instead of a conflict
+    columns = ['lesson_time_id', 'auditorium_id', 'course_id', 'contingent_id', 'date', 'lesson_type', 'teacher_id']
+    if len(rows) == 0:
+        return 0
+    db.query(f"create temp table import_lesson on commit drop as select {', '.join(columns)} from lesson with no data")
+    db.inserttable('import_lesson', [tuple(row[c] for c in columns) for row in rows])
+    db.query(f"""insert into lesson ({', '.join(columns)})
+                 select {', '.join('s.' + c for c in columns)} from import_lesson s
+                 where not exists (select 1 from lesson l
+                                   where l.contingent_id = s.contingent_id and l.date = s.date
+                                     and l.lesson_time_id = s.lesson_time_id and l.course_id = s.course_id)""")
+    src.lms_data_loader.refresh_timetable(db, rows)
+    return len(rows)
+
+
+def import_snapshot(snapshot, loaders, db, files_per_transaction=200):
+    state = snapshot.load_state()
+
+    def step(name, func, done=None):
+        # done: what to record as imported, [name] by default
+        if name in state['done']:
+            print(f"skip {name}: already imported", file=sys.stderr)
+            return
+        progress = Progress(f"import {name}")
+        db.begin()
+        try:
+            progress.step(func())
+            db.end()
+        except BaseException:
+            db.rollback()
+            raise
+        state['done'] += done or [name]
+        snapshot.save_state(state)
+        progress.finish()
+
+    buildings = snapshot_objects(snapshot, 'buildings', loaders['buildings'])
+    step('buildings', lambda: copy_rows(db, 'buildings', ['id', 'name', 'addr'], list(buildings.values())))
+
+    def import_auditoriums():
+        auditoriums = snapshot_objects(snapshot, 'auditoriums', loaders['auditoriums'])
+        building_ids = dict(db.query("select name, id from buildings").getresult())
+        for auditorium in auditoriums.values():
+            auditorium['building_id'] = building_ids.get(auditorium.pop('building_name'))
+        return copy_rows(db, 'auditoriums', ['id', 'building_id', 'number', 'auditorium_type'],
+                         list(auditoriums.values()))
+
+    step('auditoriums', import_auditoriums)
+
+    person_columns = ['id', 'first_name', 'last_name', 'patronymic_name', 'email']
+    step('teachers', lambda: copy_rows(db, 'teachers', person_columns, list(
+        snapshot_objects(snapshot, 'teachers', loaders['teachers']).values())))
+    step('students', lambda: copy_rows(db, 'students', person_columns + ['group_name'], list(
+        snapshot_objects(snapshot, 'students', loaders['students']).values())))
+
+    # Progress is kept by file name: a crawl may add files between runs, positions in the list would shift
+    imported = set(state['done'])
+    files = [path for path in snapshot.files('lessons') if lesson_step(path) not in imported]
+    for i in range(0, len(files), files_per_transaction):
+        part = files[i:i + files_per_transaction]
+        step(f"lessons {os.path.basename(part[0])}..{os.path.basename(part[-1])}",
+             lambda: import_lessons(snapshot, loaders, db, part), [lesson_step(path) for path in part])
+
+
+def lesson_step(path):
+    return 'lessons/' + os.path.basename(path)
+
+
+def import_lessons(snapshot, loaders, db, files):
+    lesson_loader = loaders['lessons']
+    teacher_ids = dict(db.query("""select concat_ws(' ', last_name, first_name, patronymic_name), id
+                                   from teachers""").getresult())
+    auditoriums = {row[0] for row in db.query("select id from auditoriums").getresult()}
+    students = {row[0] for row in db.query("select id from students").getresult()}
+
+    courses = {}
+    contingents = {}
+    students_to_contingents = set()
+    lessons = {}
+    for path in files:
+        student_id = int(os.path.basename(path).split('_')[0])
+        if student_id not in students:
+            logger.warning(f"student_id {student_id} not found in DB, skip {path}")
+            continue
+        for raw in snapshot.read(path):
+            lesson = lesson_loader.normalize_lesson(raw)
+            if lesson['auditorium_id'] not in auditoriums:
+                logger.warning(f"auditorium {lesson['auditorium_id']} is not in snapshot, skip lesson {lesson}")
+                continue
+            courses[lesson['course_id']] = lesson['course']
+            contingents[lesson['contingent_id']] = lesson['contingent']
+            students_to_contingents.add((student_id, lesson['contingent_id']))
+            # Every member of a contingent gets the same lessons, keep one copy
+            key = (lesson['contingent_id'], lesson['date'], lesson['lesson_time_id'], lesson['course_id'])
+            lessons[key] = {
+                'lesson_time_id': lesson['lesson_time_id'],
+                'auditorium_id': lesson['auditorium_id'],
+                'course_id': lesson['course_id'],
+                'contingent_id': lesson['contingent_id'],
+                'date': lesson['date'],
+                'lesson_type': lesson['lesson_type'],
+                'teacher_id': teacher_ids.get(lesson['teacher']),
+            }
+
+    copy_rows(db, 'learning_courses', ['id', 'shortname', 'fullname'],
+              [{'id': id, 'shortname': name, 'fullname': name} for id, name in courses.items()], update=False)
+    copy_rows(db, 'contingents', ['id', 'contingent_name'],
+              [{'id': id, 'contingent_name': name} for id, name in contingents.items()], update=False)
+    copy_rows(db, 'students_to_contingents', ['student_id', 'contingent_id'],
+              [{'student_id': s, 'contingent_id': c} for s, c in students_to_contingents],
+              key=('student_id', 'contingent_id'))
+    copy_lessons(db, list(lessons.values()))
+    return len(files)
+
+
+def snapshot_student_ids(snapshot):
+    ids = set()
+    for path in snapshot.files('students'):
+        ids.update(obj['id'] for obj in snapshot.read(path))
+    return sorted(ids)
+
+
+def parse_date(value):
+    for fmt in ("%Y-%m-%d", "%Y.%m.%d"):
+        try:
+            return dt.datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"Bad date {value}, expected YYYY-MM-DD")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Crawl RUZ into snapshot files and bulk import them into DB')
+    subparsers = parser.add_subparsers(dest='command')
+
+    crawl = subparsers.add_parser('crawl', help='save RUZ responses to a snapshot directory')
+    crawl.add_argument('snapshot', help='snapshot directory, an interrupted crawl continues where it stopped')
+    crawl.add_argument('--begin', type=parse_date, required=True)
+    crawl.add_argument('--end', type=parse_date, required=True)
+    crawl.add_argument('--kinds', default=','.join(reference_kinds + ['lessons']),
+                       help='comma separated subset of ' + ', '.join(reference_kinds + ['lessons']))
+    crawl.add_argument('--workers', type=int, default=settings.lms_pipeline['fetch_workers'])
+    crawl.add_argument('--import', dest='do_import', action='store_true', help='import the snapshot afterwards')
+
+    imp = subparsers.add_parser('import', help='bulk load a snapshot directory into DB')
+    imp.add_argument('snapshot')
+    imp.add_argument('--restart', action='store_true', help='forget progress of a previous import')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    snapshot = Snapshot(args.snapshot)
+    loaders = make_loaders()
+
+    if args.command == 'crawl':
+        kinds = [kind.strip() for kind in args.kinds.split(',')]
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for kind in reference_kinds:
+                if kind in kinds:
+                    crawl_tree(snapshot, kind, loaders[kind], executor)
+            if 'lessons' in kinds:
+                crawl_lessons(snapshot, loaders['lessons'], snapshot_student_ids(snapshot),
+                              args.begin, args.end, executor)
+        if not args.do_import:
+            return 0
+    elif args.restart:
+        snapshot.save_state({'done': []})
+
+    db = src.server_backend.dbconnect()
+    try:
+        import_snapshot(snapshot, loaders, db)
+    finally:
+        db.close()
+    notify_servers()
+    return 0
+
+
+def notify_servers():
+    # Running servers reload these tables into their catalogs and forget RUZ searches that found nothing
+    bus = src.invalidation.InvalidationBus(src.server_backend.dbconnect)
+    try:
+        for table in reference_kinds:
+            bus.publish('written', table=table)
+    except Exception as e:
+        print(f"Could not notify running servers: {type(e)}: {e}", file=sys.stderr)
+    finally:
+        bus.stop()
@@ -0,0 +1,76 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class NegativeCache:
+    # Remembers (loader type, term) pairs for which RUZ found nothing, so that repeated
+    # lookups of unknown teachers, auditoriums or bad search strings don't go upstream every time.
+    # Bounded LRU, entries expire after ttl seconds.
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expirations': 0}
+
+    @staticmethod
+    def key(kind, term):
+        return kind, ' '.join(str(term).lower().split())
+
+    def contains(self, kind, term):
+        key = self.key(kind, term)
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                self.counters['expirations'] += 1
+                expires = None
+            if expires is None:
+                self.counters['misses'] += 1
+                return False
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return True
+
+    def add(self, kind, term):
+        key = self.key(kind, term)
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            self.counters['stores'] += 1
+            while self.max_size < len(self.entries):
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def clear(self, kind=None):
+        with self.lock:
+            if kind is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if key[0] == kind]:
+                del self.entries[key]
+
+    def holds(self, kind):
+        with self.lock:
+            return any(key[0] == kind for key in self.entries)
+
+    def discard(self, kind, rows):
+        # Forgets the searches that rows just written to kind may answer now: all words of the term
+        # occur in the text columns of some row. Rows without text (ids only) answer nothing
+        texts = [' '.join(str(value).lower() for value in row.values() if isinstance(value, str)) for row in rows]
+        texts = [text for text in texts if text]
+        if len(texts) == 0:
+            return
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == kind]:
+                words = [word for word in re.split(r'[\s,|]+', key[1]) if word]
+                if any(all(word in text for word in words) for text in texts):
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            # every hit is a RUZ request that was not made
+            return {**self.counters, 'size': len(self.entries), 'saved_upstream_calls': self.counters['hits']}
@@ -0,0 +1,156 @@
+import logging
+import sys
+import threading
+
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+
+class Record:
+    # Rows of small reference tables, kept for the whole server lifetime.
+    # __slots__ instead of dicts, repeated strings (addresses, types, first names) are interned.
+    __slots__ = ()
+
+    def __init__(self, row):
+        for field in self.__slots__:
+            value = row.get(field)
+            if isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{f}={getattr(self, f)!r}' for f in self.__slots__)})"
+
+
+class LessonTime(Record):
+    __slots__ = ('id', 'time_start', 'time_end')
+
+
+class Building(Record):
+    __slots__ = ('id', 'name', 'addr')
+
+
+class Auditorium(Record):
+    __slots__ = ('id', 'building_id', 'number', 'auditorium_type')
+
+
+class Teacher(Record):
+    __slots__ = ('id', 'first_name', 'last_name', 'patronymic_name', 'email')
+
+
+class LearningCourse(Record):
+    __slots__ = ('id', 'shortname', 'fullname')
+
+
+class Contingent(Record):
+    __slots__ = ('id', 'contingent_name')
+
+
+class Catalog:
+    tables = {
+        'lesson_time': LessonTime,
+        'buildings': Building,
+        'auditoriums': Auditorium,
+        'teachers': Teacher,
+        'learning_courses': LearningCourse,
+        'contingents': Contingent,
+    }
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_id = {table: {} for table in Catalog.tables}
+        self.buildings_by_name = {}
+        self.teachers_by_name = {}
+
+    def load(self, db):
+        logger.info("Loading catalog")
+        with self.lock:
+            for table in Catalog.tables:
+                self.by_id[table] = {}
+                self.reload(db, table)
+        logger.info(f"Catalog loaded: {', '.join(f'{t} {len(rows)}' for t, rows in self.by_id.items())}")
+
+    def reload(self, db, table, ids=None):
+        columns = ', '.join(Catalog.tables[table].__slots__)
+        if ids is None:
+            rows = db.query(f"select {columns} from {table}").dictresult()
+        else:
+            ids = [int(id) for id in ids]
+            if len(ids) == 0:
+                return
+            rows = db.query_formatted(f"select {columns} from {table} where id = any(%s::bigint[])",
+                                      (ids,)).dictresult()
+        self.update(table, rows)
+
+    def update(self, table, rows):
+        # Called with rows just written by loaders, so the catalog follows DB without a reload
+        if table not in Catalog.tables:
+            return
+        record_type = Catalog.tables[table]
+        with self.lock:
+            records = self.by_id[table]
+            for row in rows:
+                record = record_type(row)
+                records[record.id] = record
+                if table == 'buildings':
+                    self.buildings_by_name[record.name] = record.id
+                elif table == 'teachers':
+                    name = ' '.join(x for x in [record.last_name, record.first_name, record.patronymic_name]
+                                    if x is not None)
+                    self.teachers_by_name[name] = record.id
+
+    def get(self, table, id):
+        return self.by_id[table].get(id)
+
+    def building_id(self, name):
+        return self.buildings_by_name.get(name)
+
+    def teacher_id(self, name):
+        return self.teachers_by_name.get(name)
+
+    def ensure(self, db, rows, references):
+        # references: {column in rows: table}, loads whatever another process wrote and we haven't seen yet
+        for column, table in references.items():
+            missing = {row[column] for row in rows if row[column] is not None} - self.by_id[table].keys()
+            if len(missing) != 0:
+                logger.debug(f"Catalog misses {len(missing)} {table}, reloading them")
+                self.reload(db, table, missing)
+
+    def enrich_lessons(self, db, rows):
+        # Turns narrow lesson rows into what get_timetable_by_user_id() returns
+        self.ensure(db, rows, {'lesson_time_id': 'lesson_time', 'auditorium_id': 'auditoriums',
+                               'course_id': 'learning_courses', 'contingent_id': 'contingents'})
+        auditoriums = {a.id: a for a in (self.get('auditoriums', row['auditorium_id']) for row in rows)
+                       if a is not None}
+        self.ensure(db, [{'building_id': a.building_id} for a in auditoriums.values()],
+                    {'building_id': 'buildings'})
+
+        result = []
+        for row in rows:
+            lesson_time = self.get('lesson_time', row['lesson_time_id'])
+            auditorium = auditoriums.get(row['auditorium_id'])
+            building = None if auditorium is None else self.get('buildings', auditorium.building_id)
+            course = self.get('learning_courses', row['course_id'])
+            contingent = self.get('contingents', row['contingent_id'])
+            if lesson_time is None or building is None or course is None or contingent is None:
+                # Inner joins in SQL version drop such lessons as well
+                continue
+            result.append({
+                'user_id': row['user_id'],
+                'first_name': row['first_name'],
+                'lesson_time_id': row['lesson_time_id'],
+                'date': row['date'],
+                'start': lesson_time.time_start,
+                'end': lesson_time.time_end,
+                'building_addr': building.addr,
+                'lesson_type': row['lesson_type'],
+                'flow': contingent.contingent_name,
+                'course_short_name': course.shortname,
+                'course_full_name': course.fullname,
+            })
+        return result
+
+    def size(self):
+        with self.lock:
+            return {table: len(records) for table, records in self.by_id.items()}
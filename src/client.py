@@ -3,16 +3,27 @@ import socket
 import json
 import time
 import csv
+import threading
+from datetime import datetime
+
+from src.client_cache import ClientCache
 
 
 class Connection:
+    # Dead servers are noticed by heartbeats (see Client.heartbeat), so a response may take as long
+    # as the slowest method is allowed to run on the server
+    connect_timeout = 10
+    response_timeout = 90
+
     def __init__(self, host: str, port: int):
         self.host = host
         self.port = port
         self.conn = socket.socket()
-        self.conn.settimeout(30)
+        self.conn.settimeout(Connection.connect_timeout)
         self.conn.connect((host, port))
-        self.timeout = 30
+        self.conn.settimeout(Connection.response_timeout)
+        self.timeout = Connection.response_timeout
+        self.last_used = time.monotonic()
 
     def send_packet(self, obj: dict) -> None:
         bdata = json.dumps(obj).encode()
@@ -20,13 +31,17 @@ class Connection:
         #print(f'Sending object of size {size}: {bdata}')
         packet = size.to_bytes(4, byteorder='big') + bdata
         self.conn.sendall(packet)
+        self.last_used = time.monotonic()
         #print(f'Sent {size} bytes')
 
     def recvall(self, size, time_left):
         bdata = bytes()
         while len(bdata) < size and 0 < time_left[0]:
             start = time.time()
-            bdata += self.conn.recv(size - len(bdata))
+            chunk = self.conn.recv(size - len(bdata))
+            if len(chunk) == 0:
+                raise ConnectionResetError('Connection closed by server')
+            bdata += chunk
             time_left[0] -= time.time() - start
             #print(f'Received {len(bdata)} of {size} bytes, {time_left} seconds left')
 
@@ -53,8 +68,24 @@ class Connection:
 
 
 class Client:
+    heartbeat_interval = 20
+    # Safe to send again after reconnect: reads and "set value" writes
+    retry_methods = {'get_user_info', 'get_contingent_by_user_id', 'get_timetable', 'get_deadlines', 'get_stats',
+                     'get_workload', 'change_deadline_estimate', 'change_deadline_real'}
+
     def __init__(self):
         self.c = None
+        # Background revalidation and heartbeats share the connection with the command loop
+        self.lock = threading.RLock()
+        self.cache = ClientCache()
+        self.login_name = None
+        self.session_token = None
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def owner(self):
+        return self.login_name or ''
 
     def run(self):
         print('cmd> ', end='')
@@ -78,28 +109,181 @@ class Client:
             sys.stdout.flush()
 
     def request(self, data: dict):
-        if self.c is None:
-            raise Exception('Not connected. Use command "connect <host> <port>"')
-        self.c.send_packet(data)
-        res = self.c.recv_packet()
+        with self.lock:
+            if self.c is None:
+                raise Exception('Not connected. Use command "connect <host> <port>"')
+            try:
+                self.c.send_packet(data)
+                res = self.c.recv_packet()
+            except (OSError, TimeoutError):
+                self.reconnect()
+                if data['method'] not in Client.retry_methods:
+                    raise Exception('Connection was lost and restored, check the result and repeat the command')
+                self.c.send_packet(data)
+                res = self.c.recv_packet()
         if res['status'] != 'ok':
             raise Exception(res['exception'])
         return res['data']
 
+    def request_stream(self, data: dict):
+        with self.lock:
+            if self.c is None:
+                raise Exception('Not connected. Use command "connect <host> <port>"')
+            try:
+                self.c.send_packet({**data, 'stream': True})
+                res = self.c.recv_packet()
+            except (OSError, TimeoutError):
+                self.reconnect()
+                self.c.send_packet({**data, 'stream': True})
+                res = self.c.recv_packet()
+            while True:
+                if res['status'] != 'ok':
+                    raise Exception(res['exception'])
+                if res.get('end', False):
+                    return
+                for row in res['chunk']:
+                    yield row
+                try:
+                    res = self.c.recv_packet()
+                except (OSError, TimeoutError):
+                    # Part of the rows is already printed, don't print them twice
+                    self.reconnect()
+                    raise Exception('Connection was lost and restored, repeat the command')
+
+    def reconnect(self):
+        # Replaces a dead connection and logs in again with the session token if there was a login
+        with self.lock:
+            host, port = self.c.host, self.c.port
+            try:
+                self.c.conn.close()
+            except OSError:
+                pass
+            self.c = None
+            self.c = Connection(host, port)
+            if self.session_token is not None:
+                self.c.send_packet({'method': 'resume', 'session_token': self.session_token})
+                res = self.c.recv_packet()
+                if res['status'] != 'ok':
+                    self.session_token = None
+                    print(f'Reconnected, but could not resume session: {res["exception"]}')
+                    return
+            print('Reconnected')
+            if self.session_token is not None:
+                self.sync_pending()
+
+    def heartbeat(self):
+        while True:
+            time.sleep(Client.heartbeat_interval / 4)
+            if not self.lock.acquire(blocking=False):
+                # Busy with a request, which is a heartbeat by itself
+                continue
+            try:
+                if self.c is None or time.monotonic() - self.c.last_used < Client.heartbeat_interval:
+                    continue
+                try:
+                    self.c.send_packet({'method': 'ping'})
+                    self.c.recv_packet()
+                except (OSError, TimeoutError):
+                    try:
+                        self.reconnect()
+                    except (OSError, TimeoutError) as e:
+                        self.c = None
+                        print(f'\nConnection lost ({e}), working offline\ncmd> ', end='')
+                        sys.stdout.flush()
+            finally:
+                self.lock.release()
+
+    def print_cached(self, req: dict):
+        # Local copy is printed right away and revalidated in background, without connection it is all we have
+        cached = self.cache.get(self.owner(), req)
+        if cached is None:
+            if self.c is None:
+                raise Exception('Not connected and nothing saved for this command. Use command "connect <host> <port>"')
+            rows = []
+            self.print_array(self.save_rows(self.request_stream(req), rows))
+            self.cache.put(self.owner(), req, rows)
+            return
+
+        rows, updated = cached
+        self.print_array(rows)
+        print(f'(saved at {datetime.fromtimestamp(updated):%d-%m-%Y %H:%M:%S}'
+              f'{", checking for updates" if self.c is not None else ", offline"})')
+        if self.c is not None:
+            thread = threading.Thread(target=self.revalidate, args=(req, rows))
+            thread.daemon = True
+            thread.start()
+
+    def save_rows(self, rows, out: list):
+        for row in rows:
+            out.append(dict(row))
+            yield row
+
+    def revalidate(self, req: dict, cached: list):
+        owner = self.owner()
+        try:
+            fresh = self.request(req)
+        except Exception as e:
+            print(f'\nCould not check for updates: {e}\ncmd> ', end='')
+            sys.stdout.flush()
+            return
+        self.cache.put(owner, req, fresh)
+        if fresh != cached:
+            print(f'\nServer has newer data for "{req["method"]}", repeat the command to see it\ncmd> ', end='')
+            sys.stdout.flush()
+
+    def change_deadline(self, method: str, deadline_id: int, val: float):
+        if self.c is not None:
+            try:
+                self.request({'method': method, 'deadline_id': deadline_id, 'val': val})
+                print('ok')
+                return
+            except (OSError, TimeoutError):
+                self.c = None
+        if self.login_name is None:
+            raise Exception('Not connected. Use command "connect <host> <port>"')
+        self.cache.queue_edit(self.owner(), method, deadline_id, val)
+        print('offline, will be sent after next login')
+
+    def sync_pending(self):
+        for method, deadline_id, val in self.cache.pending_edits(self.owner()):
+            try:
+                self.request({'method': method, 'deadline_id': deadline_id, 'val': val})
+                print(f'synced {method} {deadline_id} {val}')
+            except (OSError, TimeoutError):
+                raise
+            except Exception as e:
+                print(f'dropped {method} {deadline_id} {val}: {e}')
+            self.cache.drop_edit(self.owner(), method, deadline_id)
+
+    def print_workload(self, res: dict):
+        self.print_array(res['weeks'])
+        print('Точность оценок:', ', '.join(f'{key} {value}' for key, value in res['accuracy'].items()))
+        self.print_array([{'contingent_id': row['contingent_id'], 'flow': row['flow'],
+                           'weekly_hours': ' '.join(str(h) for h in row['weekly_hours']), **row['accuracy']}
+                          for row in res['contingents']])
+        self.print_array(res['courses'])
+
     def drop_unneeded(self, row: dict, unneeded=['flow', 'course_name_short', 'deadlines_description']):
         for col in unneeded:
             row.pop(col, None)
         return row
 
-    def print_array(self, data: list):
-        if len(data) == 0:
+    def print_array(self, data):
+        # data may be a list or a row iterator (see request_stream), rows are printed as they arrive
+        writer = None
+        total = 0
+        for row in data:
+            row = self.drop_unneeded(dict(row))
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=[key for key in row], delimiter='\t')
+                writer.writeheader()
+            writer.writerow(row)
+            total += 1
+            sys.stdout.flush()
+        if total == 0:
             print('No results')
             return
-        writer = csv.DictWriter(sys.stdout, fieldnames=[key for key in self.drop_unneeded(data[0])], delimiter='\t')
-        writer.writeheader()
-        for row in data:
-            writer.writerow(self.drop_unneeded(row))
-        print(f'Total: {len(data)} rows')
+        print(f'Total: {total} rows')
 
     def process_command(self, tokens):
         if len(tokens) == 0:
@@ -130,30 +314,38 @@ class Client:
                   ' - указать предполагаемое время выполнения задания DEADLINE_ID (из вывода deadlines)', sep='\t')
             print('deadline real DEADLINE_ID HOURS',
                   ' - указать фактическое время выполнения задания DEADLINE_ID (из вывода deadlines)', sep='\t')
+            print('workload [WEEKS]',
+                  ' - нагрузка по неделям, точность оценок по группам и курсам (на WEEKS недель вперёд)', sep='\t')
+            print('profile start|stop|dump|reset|status [PERCENT [METHOD ...]]',
+                  ' - профилирование запросов на сервере (только с того же хоста)', sep='\t')
+            print('cache clear', ' - удалить сохранённые данные и неотправленные изменения текущего пользователя',
+                  sep='\t')
 
         elif tokens[0] == 'connect':
             self.c = Connection(tokens[1], int(tokens[2]))
             print('ok')
         elif tokens[0] == 'disconnect':
-            if self.c is not None:
-                self.c.close()
-                self.c = None
+            with self.lock:
+                if self.c is not None:
+                    self.c.close()
+                    self.c = None
+            self.session_token = None
             print('ok')
 
         elif tokens[0] == 'students':
-            self.print_array(self.request({'method': 'get_user_info', 'user_name': tokens[1]}))
+            self.print_array(self.request_stream({'method': 'get_user_info', 'user_name': tokens[1]}))
         elif tokens[0] == 'groups':
             req = {'method': 'get_contingent_by_user_id'}
             if 1 < len(tokens):
                 req['user_id'] = tokens[1]
-            self.print_array(self.request(req))
+            self.print_cached(req)
         elif tokens[0] == 'lessons':
             req = {'method': 'get_timetable'}
             if 1 < len(tokens):
                 req['user_id'] = tokens[1]
-            self.print_array(self.request(req))
+            self.print_cached(req)
         elif tokens[0] == 'deadlines':
-            self.print_array(self.request({'method': 'get_deadlines'}))
+            self.print_cached({'method': 'get_deadlines'})
 
         elif tokens[0] == 'new' and tokens[1] == 'deadline':
             req = {'method': 'create_deadline'}
@@ -163,26 +355,37 @@ class Client:
             self.request(req)
             print('ok')
         elif tokens[0] == 'deadline' and tokens[1] == 'estimated':
-            req = {'method': 'change_deadline_estimate'}
-            req['deadline_id'] = int(tokens[2])
-            req['val'] = float(tokens[3])
-            self.request(req)
-            print('ok')
+            self.change_deadline('change_deadline_estimate', int(tokens[2]), float(tokens[3]))
         elif tokens[0] == 'deadline' and tokens[1] == 'real':
-            req = {'method': 'change_deadline_real'}
-            req['deadline_id'] = int(tokens[2])
-            req['val'] = float(tokens[3])
-            self.request(req)
+            self.change_deadline('change_deadline_real', int(tokens[2]), float(tokens[3]))
+        elif tokens[0] == 'workload':
+            req = {'method': 'get_workload'}
+            if 1 < len(tokens):
+                req['weeks'] = int(tokens[1])
+            self.print_workload(self.request(req))
+        elif tokens[0] == 'profile':
+            req = {'method': 'profile', 'action': tokens[1] if 1 < len(tokens) else 'status'}
+            if req['action'] == 'start' and 2 < len(tokens):
+                req['percent'] = float(tokens[2])
+                req['methods'] = tokens[3:]
+            print(json.dumps(self.request(req), indent=2, ensure_ascii=False))
+        elif tokens[0] == 'cache' and tokens[1] == 'clear':
+            self.cache.clear(self.owner())
             print('ok')
 
         elif tokens[0] == 'register':
             self.request({'method': 'register', 'login': tokens[1], 'password': tokens[2], 'student_id': tokens[3]})
             print('ok')
         elif tokens[0] == 'login':
-            self.request({'method': 'login', 'login': tokens[1], 'password': tokens[2]})
+            res = self.request({'method': 'login', 'login': tokens[1], 'password': tokens[2]})
+            self.login_name = tokens[1]
+            self.session_token = res.get('session_token')
             print('ok')
+            self.sync_pending()
         elif tokens[0] == 'logout':
             self.request({'method': 'logout'})
+            self.login_name = None
+            self.session_token = None
             print('ok')
         else:
             raise Exception(f'Unknown command "{" ".join(tokens)}". Try command "help"')
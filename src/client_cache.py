@@ -0,0 +1,78 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def default_path():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'hse-timetable', 'client.sqlite3')
+
+
+class ClientCache:
+    # Local copy of the last answers for timetable, groups and deadlines, and deadline time edits
+    # made while there was no connection. Everything is per login, 'owner' below.
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Used from the command loop and from background revalidation
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("""create table if not exists responses (
+                                   owner text not null,
+                                   request text not null,
+                                   rows text not null,
+                                   updated real not null,
+                                   primary key (owner, request))""")
+            # Only the last value per (method, deadline) matters, older ones are replaced.
+            # Estimate is sent before real time ('..._estimate' < '..._real'), server requires this order
+            self.db.execute("""create table if not exists pending_edits (
+                                   owner text not null,
+                                   method text not null,
+                                   deadline_id integer not null,
+                                   val real not null,
+                                   created real not null,
+                                   primary key (owner, method, deadline_id))""")
+
+    @staticmethod
+    def request_key(req):
+        return json.dumps(req, sort_keys=True)
+
+    def get(self, owner, req):
+        with self.lock:
+            row = self.db.execute("select rows, updated from responses where owner = ? and request = ?",
+                                  (owner, self.request_key(req))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, owner, req, rows):
+        with self.lock, self.db:
+            self.db.execute("insert or replace into responses values (?, ?, ?, ?)",
+                            (owner, self.request_key(req), json.dumps(rows, ensure_ascii=False), time.time()))
+
+    def queue_edit(self, owner, method, deadline_id, val):
+        with self.lock, self.db:
+            self.db.execute("insert or replace into pending_edits values (?, ?, ?, ?, ?)",
+                            (owner, method, deadline_id, val, time.time()))
+
+    def pending_edits(self, owner):
+        with self.lock:
+            return self.db.execute("""select method, deadline_id, val from pending_edits
+                                      where owner = ? order by deadline_id, method""", (owner,)).fetchall()
+
+    def drop_edit(self, owner, method, deadline_id):
+        with self.lock, self.db:
+            self.db.execute("delete from pending_edits where owner = ? and method = ? and deadline_id = ?",
+                            (owner, method, deadline_id))
+
+    def clear(self, owner):
+        with self.lock, self.db:
+            self.db.execute("delete from responses where owner = ?", (owner,))
+            self.db.execute("delete from pending_edits where owner = ?", (owner,))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,141 @@
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+
+class TimerWheel:
+    # Hashed timer wheel: schedule and cancel are O(1), which matters because every session is
+    # rescheduled on every packet. Precision is one tick, which is plenty for idle timeouts.
+
+    def __init__(self, tick, slots):
+        self.tick_length = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.position = 0
+        self.where = {}
+        self.lock = threading.Lock()
+
+    def schedule(self, key, delay):
+        ticks = max(1, int(delay / self.tick_length + 0.5))
+        with self.lock:
+            self._cancel(key)
+            slot = (self.position + ticks) % len(self.slots)
+            # A full turn of the wheel is shorter than delay: count the turns to skip
+            self.slots[slot][key] = (ticks - 1) // len(self.slots)
+            self.where[key] = slot
+
+    def cancel(self, key):
+        with self.lock:
+            self._cancel(key)
+
+    def _cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def tick(self):
+        expired = []
+        with self.lock:
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            for key, rounds in list(slot.items()):
+                if rounds == 0:
+                    del slot[key]
+                    del self.where[key]
+                    expired.append(key)
+                else:
+                    slot[key] = rounds - 1
+        return expired
+
+    def __len__(self):
+        return len(self.where)
+
+
+class IdleReaper:
+    # Closes sessions that sent nothing (no requests, no pings) for idle_timeout seconds.
+    # Sessions are taken off the wheel while a request is being processed.
+
+    def __init__(self, idle_timeout, tick):
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel(tick, max(2, int(idle_timeout / tick) + 1))
+        self.reaped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='idle-reaper')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def touch(self, session):
+        self.wheel.schedule(session, self.idle_timeout)
+
+    def busy(self, session):
+        self.wheel.cancel(session)
+
+    def run(self):
+        next_tick = time.monotonic()
+        while not self.stopped:
+            next_tick += self.wheel.tick_length
+            time.sleep(max(0, next_tick - time.monotonic()))
+            for session in self.wheel.tick():
+                self.reaped += 1
+                logger.info(f"Closing idle connection from {session.client_addr}")
+                session.abort()
+
+    def stop(self):
+        self.stopped = True
+
+
+class SessionTokens:
+    # Signed "user_id.expires.signature" tokens: a reconnecting client resumes its login without
+    # sending the password again, and any worker process can check a token's signature by itself.
+    # Logged out tokens are kept by store (revoke_token(token, expires) and token_revoked(token),
+    # see Server), so that other workers and restarted ones refuse them too; a local copy saves lookups.
+
+    def __init__(self, secret, ttl, store=None):
+        self.secret = secret.encode()
+        self.ttl = ttl
+        self.store = store
+        self.revoked = {}
+        self.lock = threading.Lock()
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id):
+        payload = f"{int(user_id)}.{int(time.time() + self.ttl)}"
+        return payload + '.' + self.sign(payload)
+
+    def check(self, token):
+        try:
+            user_id, expires, signature = str(token).split('.')
+            payload = f"{int(user_id)}.{int(expires)}"
+        except ValueError:
+            raise Exception('Bad session token')
+        with self.lock:
+            revoked = token in self.revoked
+        if revoked or not hmac.compare_digest(signature, self.sign(payload)) or int(expires) < time.time():
+            raise Exception('Session expired, log in again')
+        if self.store is not None and self.store.token_revoked(token):
+            with self.lock:
+                self.revoked[token] = int(expires)
+            raise Exception('Session expired, log in again')
+        return int(user_id)
+
+    def revoke(self, token):
+        try:
+            expires = int(str(token).split('.')[1])
+        except (IndexError, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            for old in [t for t, e in self.revoked.items() if e < now]:
+                del self.revoked[old]
+            self.revoked[token] = expires
+        if self.store is not None:
+            self.store.revoke_token(token, expires)
@@ -0,0 +1,136 @@
+import json
+import logging
+import select
+import threading
+import time
+
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+# NOTIFY payload must be shorter than 8000 bytes
+max_ids_per_message = 500
+
+# Seconds between attempts to reconnect the listener, doubled up to the maximum
+reconnect_delay = 1
+max_reconnect_delay = 30
+
+
+class InvalidationBus:
+    # Postgres LISTEN/NOTIFY channel shared by all server processes.
+    # A process that writes something applies it to its own caches directly and publishes a message,
+    # the others get it in the listener thread and call the handler subscribed for the message kind.
+    # Messages sent while the listener was disconnected are lost, so after a reconnect handlers of
+    # the 'reconnected' kind are called to reload whatever they cache.
+
+    def __init__(self, connect, channel=None):
+        self.connect = connect
+        self.channel = channel or settings.invalidation_channel
+        self.handlers = {}
+        self.publish_db = None
+        self.publish_lock = threading.Lock()
+        self.listen_db = None
+        self.thread = None
+        self.stopped = False
+
+    def subscribe(self, kind, handler):
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind, ids=None, **payload):
+        messages = []
+        if ids is None:
+            messages.append({'kind': kind, **payload})
+        else:
+            ids = list(ids)
+            for i in range(0, len(ids), max_ids_per_message):
+                messages.append({'kind': kind, 'ids': ids[i:i + max_ids_per_message], **payload})
+        # Called after the write is committed, so a failure here must not fail the request:
+        # one retry on a new connection, then the other processes miss this message
+        with self.publish_lock:
+            for attempt in range(2):
+                try:
+                    if self.publish_db is None:
+                        self.publish_db = self.connect()
+                    for message in messages:
+                        self.publish_db.query_formatted("select pg_notify(%s, %s)",
+                                                        (self.channel, json.dumps(message, default=str)))
+                    return
+                except Exception as e:
+                    logger.warning(f"Failed to publish {kind} invalidation: {type(e)}: {e}")
+                    self._close(self.publish_db)
+                    self.publish_db = None
+
+    def start(self):
+        self.listen_db = self.connect()
+        self.listen_db.query(f"listen {self.channel}")
+        self.thread = threading.Thread(target=self.listen, name='invalidation-listener')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info(f"Listening for invalidations on {self.channel}")
+
+    def listen(self):
+        while not self.stopped:
+            try:
+                readable, _, _ = select.select([self.listen_db.fileno()], [], [], 1.0)
+                if len(readable) == 0:
+                    continue
+                while True:
+                    notify = self.listen_db.getnotify()
+                    if notify is None:
+                        break
+                    _, pid, extra = notify
+                    if pid == self.publish_pid():
+                        continue
+                    self.dispatch(json.loads(extra))
+            except Exception as e:
+                if self.stopped:
+                    return
+                logger.warning(f"Invalidation listener failed: {type(e)}: {e}, reconnecting")
+                self.reconnect()
+
+    def reconnect(self):
+        self._close(self.listen_db)
+        self.listen_db = None
+        delay = reconnect_delay
+        while not self.stopped:
+            try:
+                db = self.connect()
+                db.query(f"listen {self.channel}")
+            except Exception as e:
+                logger.warning(f"Invalidation listener can't reconnect: {type(e)}: {e}, retrying in {delay} s")
+                time.sleep(delay)
+                delay = min(delay * 2, max_reconnect_delay)
+                continue
+            self.listen_db = db
+            logger.info(f"Listening for invalidations on {self.channel} again")
+            self.dispatch({'kind': 'reconnected'})
+            return
+
+    @staticmethod
+    def _close(db):
+        if db is not None:
+            try:
+                db.close()
+            except Exception:
+                pass
+
+    def publish_pid(self):
+        # Own messages were already applied locally, they are recognized by the backend pid of the publisher
+        if self.publish_db is None:
+            return None
+        return self.publish_db.backend_pid
+
+    def dispatch(self, message):
+        logger.debug(f"Invalidation from another process: {message}")
+        for handler in self.handlers.get(message['kind'], []):
+            try:
+                handler(self.listen_db, message)
+            except Exception as e:
+                logger.warning(f"Invalidation handler for {message['kind']} failed: {type(e)}: {e}")
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join(2)
+        for db in (self.listen_db, self.publish_db):
+            self._close(db)
@@ -1,17 +1,39 @@
 import datetime as dt
+import functools
 import json
 import logging
 import pprint
 
-import requests
-import transliterate as tr
-
 import src.server_backend
 import src.settings as settings
 
 logger = logging.getLogger(settings.logger_name)
 
 
+# First names, patronymics and many last names repeat thousands of times in a crawl,
+# transliteration is the most expensive part of normalizing a person
+@functools.lru_cache(maxsize=settings.normalize_cache_size)
+def translit(text):
+    import transliterate as tr
+    return tr.translit(text, 'ru', reversed=True)
+
+
+def refresh_timetable(db, lessons):
+    # Rebuilds contingent_timetable for the contingents and dates of just written lessons
+    lessons = [lesson for lesson in lessons if lesson.get('contingent_id') is not None]
+    if len(lessons) == 0:
+        return
+    dates = [lesson['date'] for lesson in lessons]
+    db.query_formatted("select refresh_contingent_timetable(%s::bigint[], %s::date, %s::date)",
+                       (list({lesson['contingent_id'] for lesson in lessons}), min(dates), max(dates)))
+
+
+def split_name(full_name):
+    # Not memoized: full names are mostly unique, a cache miss costs more than the split
+    names = tuple(full_name.split(' '))
+    return names + (None,) * (3 - len(names))
+
+
 class DataLoader:
     def __init__(self):
         pass
@@ -27,29 +49,52 @@ class LmsDataLoader(DataLoader):
         self.requrl = LmsDataLoader.url + '?type=' + objtype + '&term='
         self.max_depth = max_depth
         self.server = server
-        if self.server is None:
-            self.db = src.server_backend.dbconnect()
-        else:
-            self.db = self.server._connection
+        self._db = None
         self.table = table
         self.objects = {}
 
+    @property
+    def db(self):
+        # Connected on first use: the pipeline and bulk import only normalize with loaders and never need it
+        if self.server is not None:
+            return self.server._connection
+        if self._db is None:
+            self._db = src.server_backend.dbconnect()
+        return self._db
+
     def normalize_obj(self, obj):
         obj.pop('type')
 
+    def normalize_objs(self, objs):
+        # Whole API response at once, subclasses override to share work between objects
+        for obj in objs:
+            self.normalize_obj(obj)
+        return objs
+
+    def link_obj(self, obj):
+        # Resolves references to other tables, normalize_obj must not touch DB
+        pass
+
+    def link_objs(self, objs):
+        for obj in objs:
+            self.link_obj(obj)
+        return objs
+
     def data(self):
         return self.objects
 
-    def load_term(self, term, save=True):
+    def fetch_term(self, term):
+        import requests
         r = requests.get(self.requrl + term, verify=False)
         if r.status_code != 200:
             raise Exception('RUZ is down')
-        objs = json.loads(r.content)
+        return json.loads(r.content)
+
+    def load_term(self, term, save=True):
+        objs = self.link_objs(self.normalize_objs(self.fetch_term(term)))
         obj_dict = {}
         for obj in objs:
-            id = obj['id']
-            self.normalize_obj(obj)
-            obj_dict[id] = obj
+            obj_dict[obj['id']] = obj
         if save:
             self.objects = {**self.objects, **obj_dict}
         return obj_dict
@@ -82,6 +127,8 @@ class LmsDataLoader(DataLoader):
         for key in objs_to_add:
             obj = objs_to_add[key]
             self.db.upsert(self.table, obj)
+        if self.server is not None:
+            self.server.notify_written(self.table, objs_to_add.values())
 
 
 class LmsBuildingLoader(LmsDataLoader):
@@ -89,6 +136,7 @@ class LmsBuildingLoader(LmsDataLoader):
     def __init__(self, server=None):
         super(LmsBuildingLoader, self).__init__('building', 'buildings', list('йцукенгшщзхъфывапролджэячсмитьбю'),
                                                 server=server)
+        self.ids_by_name = {}
 
     def normalize_obj(self, obj):
         super(LmsBuildingLoader, self).normalize_obj(obj)
@@ -97,15 +145,21 @@ class LmsBuildingLoader(LmsDataLoader):
         obj['addr'] = obj['description']
         obj.pop('description')
 
+    def load_term(self, term, save=True):
+        objs = super(LmsBuildingLoader, self).load_term(term, save)
+        for key in objs:
+            self.ids_by_name[objs[key]['name']] = key
+        return objs
+
     def get_building_id(self, name):
-        for key in self.objects:
-            if self.objects[key]['name'] == name:
-                return key
-        new = self.load_terms([name, ])
-        for key in new:
-            if new[key]['name'] == name:
-                return key
-        return None
+        if self.server is not None:
+            id = self.server.catalog.building_id(name)
+            if id is not None:
+                return id
+        if name in self.ids_by_name:
+            return self.ids_by_name[name]
+        self.load_terms([name, ])
+        return self.ids_by_name.get(name)
 
 
 class LmsAuditoriumLoader(LmsDataLoader):
@@ -121,9 +175,22 @@ class LmsAuditoriumLoader(LmsDataLoader):
         obj.pop('description')
         obj['number'] = obj['label']
         obj.pop('label')
-        obj['building_id'] = self.server.get_building(building_name=descr[1])[0]['id']
+        obj['building_name'] = descr[1]
         obj['auditorium_type'] = descr[2]
 
+    def link_obj(self, obj):
+        self.link_objs([obj])
+
+    def link_objs(self, objs):
+        # One lookup per building, a response usually has many auditoriums of the same building
+        building_ids = {}
+        for obj in objs:
+            name = obj.pop('building_name')
+            if name not in building_ids:
+                building_ids[name] = self.server.get_building(building_name=name)[0]['id']
+            obj['building_id'] = building_ids[name]
+        return objs
+
 
 class LmsPersonLoader(LmsDataLoader):
     def __init__(self, objtype, table, server=None):
@@ -140,9 +207,7 @@ class LmsPersonLoader(LmsDataLoader):
         obj['email'] = self.make_email(name[0], name[1], name[2])
 
     def split_name(self, full_name):
-        names = full_name.split(' ')
-        names += [None, ] * (3 - len(names))
-        return names
+        return split_name(full_name)
 
     def join_names(self, last_name='', first_name='', patronymic_name=''):
         return ' '.join([x for x in [last_name, first_name, patronymic_name] if x is not None])
@@ -157,9 +222,9 @@ class LmsPersonLoader(LmsDataLoader):
             return None
         if self.email_domain is None:
             return None
-        fn = tr.translit(first_name, 'ru', reversed=True)
-        pn = tr.translit(patronymic_name, 'ru', reversed=True)
-        ln = tr.translit(last_name, 'ru', reversed=True)
+        fn = translit(first_name)
+        pn = translit(patronymic_name)
+        ln = translit(last_name)
         return (fn[0] + pn[0] + ln + '@' + self.email_domain).lower().replace('-', '').replace("'", '')
 
 
@@ -191,15 +256,20 @@ class LmsLessonLoader:
 
     def __init__(self, auditoriumLoader, teacherLoader, server=None):
         self.server = server
-        if self.server is None:
-            self.db = src.server_backend.dbconnect()
-        else:
-            self.db = self.server._connection
+        self._db = None
         self.auditoriumLoader = auditoriumLoader
         self.teacherLoader = teacherLoader
         self.table = 'lesson'
         self.lessons = {}
 
+    @property
+    def db(self):
+        if self.server is not None:
+            return self.server._connection
+        if self._db is None:
+            self._db = src.server_backend.dbconnect()
+        return self._db
+
     def normalize_lesson(self, lesson):
         norm = {}
         norm['id'] = lesson['date'] + str(lesson['lessonNumberEnd'])
@@ -226,13 +296,16 @@ class LmsLessonLoader:
 
         course = self.db.query(f"""SELECT * FROM learning_courses WHERE id={lesson['course_id']}""").dictresult()
         if len(course) == 0:
-            self.db.insert('learning_courses',
-                           {'id': lesson['course_id'], 'shortname': lesson['course'], 'fullname': lesson['course']})
+            course = self.db.insert('learning_courses', {'id': lesson['course_id'], 'shortname': lesson['course'],
+                                                         'fullname': lesson['course']})
+            self.server.notify_written('learning_courses', [course])
         lesson.pop('course')
 
         cont = self.db.query(f"""SELECT * FROM contingents WHERE id={lesson['contingent_id']}""").dictresult()
         if len(cont) == 0:
-            self.db.insert('contingents', {'id': lesson['contingent_id'], 'contingent_name': lesson['contingent']})
+            cont = self.db.insert('contingents',
+                                  {'id': lesson['contingent_id'], 'contingent_name': lesson['contingent']})
+            self.server.notify_written('contingents', [cont])
         lesson.pop('contingent')
 
         self.db.query(f"""INSERT INTO students_to_contingents VALUES ({student_id}, {lesson[
@@ -251,19 +324,23 @@ class LmsLessonLoader:
     def data(self):
         return self.lessons
 
-    def load_lessons(self, student_id, begin, end=None, save=True):
-        pp = pprint.PrettyPrinter(indent=4, width=140)
-        student = self.db.query(f"""SELECT * FROM students WHERE id={student_id}""").dictresult()
-        if len(student) == 0:
-            raise Exception("student_id " + str(student_id) + " not found in DB, load student first")
+    def fetch_lessons(self, student_id, begin, end=None):
         if end is None:
             end = begin
+        import requests
         requrl = LmsLessonLoader.url + str(student_id)
         params = {'start': begin.strftime("%Y.%m.%d"), 'end': end.strftime("%Y.%m.%d"), 'lng': 1}
         r = requests.get(requrl, params=params, verify=False)
         if r.status_code != 200:
             raise Exception('RUZ is down')
-        lessons = json.loads(r.content)
+        return json.loads(r.content)
+
+    def load_lessons(self, student_id, begin, end=None, save=True):
+        pp = pprint.PrettyPrinter(indent=4, width=140)
+        student = self.db.query(f"""SELECT * FROM students WHERE id={student_id}""").dictresult()
+        if len(student) == 0:
+            raise Exception("student_id " + str(student_id) + " not found in DB, load student first")
+        lessons = self.fetch_lessons(student_id, begin, end)
         lessons_dict = {}
         for lesson in lessons:
             id = lesson['date'] + str(lesson['lessonNumberEnd'])
@@ -286,6 +363,7 @@ class LmsLessonLoader:
         for key in l:
             obj = l[key]
             self.db.upsert(self.table, obj)
+        refresh_timetable(self.db, l.values())
 
 
 def test_loader():
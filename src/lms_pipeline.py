@@ -0,0 +1,394 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import src.cache
+import src.lms_data_loader
+import src.server_backend
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+# Passed along a queue when the upstream stage is finished, every worker puts it back for its siblings
+_STOP = None
+
+
+class TermJob:
+    def __init__(self, loader, term):
+        self.loader = loader
+        self.term = term
+
+    def __repr__(self):
+        return f"TermJob({self.loader.table}, {self.term!r})"
+
+
+class LessonJob:
+    def __init__(self, student_id, begin, end=None):
+        self.student_id = student_id
+        self.begin = begin
+        self.end = end
+
+    def __repr__(self):
+        return f"LessonJob({self.student_id}, {self.begin}, {self.end})"
+
+
+class DbWorker:
+    # pg connections are not thread-safe, so every connection is pinned to its own thread
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.db = None
+
+    def _call(self, func, args):
+        if self.db is None:
+            self.db = src.server_backend.dbconnect()
+        try:
+            return func(self.db, *args)
+        except Exception:
+            # Workers of a long-lived pipeline must not keep a broken connection, reconnect on next call
+            self._close()
+            raise
+
+    def run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, self._call, func, args)
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def close(self):
+        self.executor.submit(self._close).result()
+        self.executor.shutdown()
+
+
+class LmsPipeline:
+    # fetch -> normalize -> link -> write, stages are connected with bounded queues,
+    # so a slow stage stops the ones before it instead of piling up responses in memory.
+    # Link stage resolves buildings, auditoriums and teachers for a whole batch at once.
+
+    def __init__(self, server=None, fetch_workers=None, normalize_workers=None, write_workers=None,
+                 queue_size=None, link_batch_size=None):
+        conf = settings.lms_pipeline
+        self.fetch_workers = fetch_workers or conf['fetch_workers']
+        self.normalize_workers = normalize_workers or conf['normalize_workers']
+        self.write_workers = write_workers or conf['write_workers']
+        self.queue_size = queue_size or conf['queue_size']
+        self.link_batch_size = link_batch_size or conf['link_batch_size']
+        self.server = server
+
+        if server is not None:
+            self.student_loader = server.student_loader
+            self.building_loader = server.building_loader
+            self.auditorium_loader = server.auditorium_loader
+            self.teacher_loader = server.teacher_loader
+            self.lesson_loader = server.lesson_loader
+            self.negative_cache = server.negative_cache
+        else:
+            self.negative_cache = src.cache.NegativeCache(**settings.negative_cache)
+            self.student_loader = src.lms_data_loader.LmsStudentLoader()
+            self.building_loader = src.lms_data_loader.LmsBuildingLoader()
+            self.auditorium_loader = src.lms_data_loader.LmsAuditoriumLoader(self.building_loader)
+            self.teacher_loader = src.lms_data_loader.LmsTeacherLoader()
+            self.lesson_loader = src.lms_data_loader.LmsLessonLoader(self.auditorium_loader, self.teacher_loader)
+
+        self.http_executor = ThreadPoolExecutor(max_workers=self.fetch_workers)
+        self.cpu_executor = ThreadPoolExecutor(max_workers=self.normalize_workers)
+        self.link_db = DbWorker()
+        self.write_dbs = [DbWorker() for _ in range(self.write_workers)]
+        self.stats = {'jobs': 0, 'fetched': 0, 'normalized': 0, 'written': 0, 'failed': 0}
+        self.loop = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
+
+    def submit(self, jobs):
+        # For a long-lived pipeline (see Server.run_pipeline): jobs run on an event loop thread started
+        # on first use, executors and DB connections stay open between calls and are shared by callers
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(target=self.loop.run_forever, name='lms-pipeline')
+                self.loop_thread.daemon = True
+                self.loop_thread.start()
+        return asyncio.run_coroutine_threadsafe(self.run(jobs), self.loop).result()
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop = None
+        self.http_executor.shutdown()
+        self.cpu_executor.shutdown()
+        self.link_db.close()
+        for db in self.write_dbs:
+            db.close()
+
+    def run_sync(self, jobs):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run(jobs))
+        finally:
+            loop.close()
+            self.close()
+
+    async def run(self, jobs):
+        fetched = asyncio.Queue(maxsize=self.queue_size)
+        normalized = asyncio.Queue(maxsize=self.queue_size)
+        linked = asyncio.Queue(maxsize=self.queue_size)
+        jobs_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def feed():
+            for job in jobs:
+                self.stats['jobs'] += 1
+                await jobs_queue.put(job)
+            await jobs_queue.put(_STOP)
+
+        await asyncio.gather(
+            feed(),
+            self._stage([self._fetch_worker(jobs_queue, fetched) for _ in range(self.fetch_workers)], fetched),
+            self._stage([self._normalize_worker(fetched, normalized) for _ in range(self.normalize_workers)],
+                        normalized),
+            self._stage([self._link_worker(normalized, linked)], linked),
+            self._stage([self._write_worker(linked, db) for db in self.write_dbs], None),
+        )
+        logger.info(f"Pipeline finished: {self.stats}")
+        return self.stats
+
+    async def _stage(self, workers, outbox):
+        await asyncio.gather(*workers)
+        if outbox is not None:
+            await outbox.put(_STOP)
+
+    async def _get(self, inbox):
+        item = await inbox.get()
+        if item is _STOP:
+            await inbox.put(_STOP)
+        return item
+
+    def _http(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.http_executor, func, *args)
+
+    async def _fetch_worker(self, inbox, outbox):
+        while True:
+            job = await self._get(inbox)
+            if job is _STOP:
+                return
+            try:
+                if isinstance(job, LessonJob):
+                    raw = await self._http(self.lesson_loader.fetch_lessons, job.student_id, job.begin, job.end)
+                else:
+                    raw = await self._http(job.loader.fetch_term, job.term)
+            except Exception as e:
+                logger.warning(f"Failed to fetch {job}: {type(e)}: {e}")
+                self.stats['failed'] += 1
+                continue
+            self.stats['fetched'] += 1
+            await outbox.put((job, raw))
+
+    def _normalize(self, job, raw):
+        if isinstance(job, LessonJob):
+            return [self.lesson_loader.normalize_lesson(lesson) for lesson in raw]
+        return job.loader.normalize_objs(raw)
+
+    async def _normalize_worker(self, inbox, outbox):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self._get(inbox)
+            if item is _STOP:
+                return
+            job, raw = item
+            try:
+                objs = await loop.run_in_executor(self.cpu_executor, self._normalize, job, raw)
+            except Exception as e:
+                logger.warning(f"Failed to normalize {job}: {type(e)}: {e}")
+                self.stats['failed'] += 1
+                continue
+            self.stats['normalized'] += 1
+            await outbox.put((job, objs))
+
+    async def _link_worker(self, inbox, outbox):
+        while True:
+            item = await self._get(inbox)
+            if item is _STOP:
+                return
+            batch = [item]
+            while len(batch) < self.link_batch_size and not inbox.empty():
+                item = inbox.get_nowait()
+                if item is _STOP:
+                    await inbox.put(_STOP)
+                    break
+                batch.append(item)
+            try:
+                unit = await self._link_batch(batch)
+            except Exception as e:
+                logger.warning(f"Failed to link batch of {len(batch)} jobs: {type(e)}: {e}")
+                self.stats['failed'] += len(batch)
+                continue
+            await outbox.put((len(batch), unit))
+
+    async def _write_worker(self, inbox, db):
+        while True:
+            item = await self._get(inbox)
+            if item is _STOP:
+                return
+            jobs, unit = item
+            try:
+                await db.run(write_unit, unit)
+            except Exception as e:
+                logger.warning(f"Failed to write batch of {jobs} jobs: {type(e)}: {e}")
+                self.stats['failed'] += jobs
+                continue
+            self.stats['written'] += jobs
+            if self.server is not None:
+                for op, table, rows in unit:
+                    if op != 'refresh':
+                        self.server.notify_written(table, rows)
+
+    async def _fetch_terms(self, loader, terms):
+        # Dependencies missing in DB are searched in RUZ the same way Server.get_simple_data does
+        async def fetch(term):
+            if self.negative_cache.contains(loader.table, term):
+                return []
+            try:
+                raw = await self._http(loader.fetch_term, term)
+            except Exception as e:
+                logger.warning(f"Failed to fetch {loader.table} {term!r}: {type(e)}: {e}")
+                return []
+            if len(raw) == 0:
+                if self.server is not None:
+                    self.server.remember_missing(loader.table, term)
+                else:
+                    self.negative_cache.add(loader.table, term)
+            return loader.normalize_objs(raw)
+
+        objs = []
+        for part in await asyncio.gather(*[fetch(term) for term in terms]):
+            objs += part
+        return objs
+
+    async def _link_batch(self, batch):
+        lessons = []
+        objs = {}
+        for job, items in batch:
+            if isinstance(job, LessonJob):
+                for lesson in items:
+                    lesson['student_id'] = job.student_id
+                lessons += items
+            else:
+                objs.setdefault(job.loader.table, []).extend(items)
+
+        known_auditoriums = await self.link_db.run(select_ids, 'auditoriums',
+                                                   list({l['auditorium_id'] for l in lessons}))
+        auditorium_terms = {l['auditorium'] + ' | ' + l['building'] for l in lessons
+                            if l['auditorium_id'] not in known_auditoriums}
+        auditoriums = objs.get('auditoriums', []) + await self._fetch_terms(self.auditorium_loader,
+                                                                             auditorium_terms)
+
+        buildings = objs.get('buildings', [])
+        building_names = list({a['building_name'] for a in auditoriums} - {b['name'] for b in buildings})
+        building_ids = await self.link_db.run(select_buildings, building_names)
+        buildings += await self._fetch_terms(self.building_loader,
+                                             [name for name in building_names if name not in building_ids])
+        building_ids.update({b['name']: b['id'] for b in buildings})
+        for auditorium in auditoriums:
+            auditorium['building_id'] = building_ids.get(auditorium.pop('building_name'))
+
+        teachers = objs.get('teachers', [])
+        teacher_names = list({l['teacher'] for l in lessons if l['teacher']})
+        teacher_ids = await self.link_db.run(select_teachers, teacher_names)
+        teachers += await self._fetch_terms(self.teacher_loader,
+                                            [name for name in teacher_names if name not in teacher_ids])
+        for teacher in teachers:
+            name = self.teacher_loader.join_names(teacher['last_name'], teacher['first_name'],
+                                                  teacher['patronymic_name'])
+            teacher_ids.setdefault(name, teacher['id'])
+
+        students = await self.link_db.run(select_ids, 'students', list({l['student_id'] for l in lessons}))
+        courses = {}
+        contingents = {}
+        students_to_contingents = set()
+        lesson_rows = []
+        for lesson in lessons:
+            if lesson['student_id'] not in students:
+                logger.warning(f"student_id {lesson['student_id']} not found in DB, load student first")
+                continue
+            courses[lesson['course_id']] = lesson['course']
+            contingents[lesson['contingent_id']] = lesson['contingent']
+            students_to_contingents.add((lesson['student_id'], lesson['contingent_id']))
+            lesson_rows.append({
+                'lesson_time_id': lesson['lesson_time_id'],
+                'auditorium_id': lesson['auditorium_id'],
+                'course_id': lesson['course_id'],
+                'contingent_id': lesson['contingent_id'],
+                'date': lesson['date'],
+                'lesson_type': lesson['lesson_type'],
+                'teacher_id': teacher_ids.get(lesson['teacher']),
+            })
+
+        # Order matters: every table goes after the ones it references
+        unit = [('upsert', 'buildings', buildings),
+                ('upsert', 'auditoriums', auditoriums),
+                ('upsert', 'teachers', teachers)]
+        for table in objs:
+            if table not in ('buildings', 'auditoriums', 'teachers'):
+                unit.append(('upsert', table, objs[table]))
+        unit += [('insert', 'learning_courses',
+                  [{'id': id, 'shortname': name, 'fullname': name} for id, name in courses.items()]),
+                 ('insert', 'contingents',
+                  [{'id': id, 'contingent_name': name} for id, name in contingents.items()]),
+                 ('insert', 'students_to_contingents',
+                  [{'student_id': s, 'contingent_id': c} for s, c in students_to_contingents]),
+                 ('upsert', 'lesson', lesson_rows),
+                 ('refresh', 'contingent_timetable', lesson_rows)]
+        return [step for step in unit if len(step[2]) != 0]
+
+
+def select_ids(db, table, ids):
+    if len(ids) == 0:
+        return set()
+    rows = db.query_formatted(f"select id from {table} where id = any(%s::bigint[])", (ids,)).getresult()
+    return {row[0] for row in rows}
+
+
+def select_buildings(db, names):
+    if len(names) == 0:
+        return {}
+    rows = db.query_formatted("select name, id from buildings where name = any(%s::text[])", (names,)).getresult()
+    return dict(rows)
+
+
+def select_teachers(db, names):
+    if len(names) == 0:
+        return {}
+    rows = db.query_formatted("""select concat_ws(' ', last_name, first_name, patronymic_name), id from teachers
+                                 where concat_ws(' ', last_name, first_name, patronymic_name) = any(%s::text[])""",
+                              (names,)).getresult()
+    return dict(rows)
+
+
+def write_unit(db, unit):
+    db.begin()
+    try:
+        for op, table, rows in unit:
+            if op == 'refresh':
+                src.lms_data_loader.refresh_timetable(db, rows)
+                continue
+            for row in rows:
+                if op == 'upsert':
+                    db.upsert(table, row)
+                else:
+                    columns = list(row)
+                    params = ', '.join(['%s'] * len(columns))
+                    db.query_formatted(
+                        f"insert into {table} ({', '.join(columns)}) values ({params}) on conflict do nothing",
+                        [row[c] for c in columns])
+        db.end()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def run_sync(jobs, server=None):
+    return LmsPipeline(server=server).run_sync(jobs)
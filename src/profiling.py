@@ -0,0 +1,140 @@
+import cProfile
+import heapq
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+
+class RequestProfiler:
+    # Runs a sampled share of requests under cProfile, aggregates profiles per method and keeps
+    # the slowest profiled requests. When it is off the only cost per request is one attribute check.
+    # Only one request is profiled at a time: profilers of concurrent threads would get in each
+    # other's way, and it keeps the overhead bounded while profiling is on.
+
+    def __init__(self, directory, percent, methods, keep_slowest, admin_token=None):
+        self.directory = directory
+        self.percent = percent
+        self.methods = set(methods)
+        self.keep_slowest = keep_slowest
+        self.admin_token = admin_token
+        self.enabled = False
+        self.active = threading.Lock()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.by_method = {}
+            self.slowest = []
+            self.counters = {'profiled': 0, 'skipped_busy': 0}
+            self.started = time.time()
+
+    def start(self, methods=None, percent=None):
+        if methods is not None:
+            self.methods = set(methods)
+        if percent is not None:
+            self.percent = min(100.0, max(0.0, float(percent)))
+        self.enabled = True
+        logger.info(f"Profiling {self.percent}% of {', '.join(sorted(self.methods)) or 'all'} requests")
+
+    def stop(self):
+        self.enabled = False
+        logger.info("Profiling stopped")
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def sampled(self, method):
+        if not self.enabled:
+            return False
+        if self.methods and method not in self.methods:
+            return False
+        return random.random() * 100 < self.percent
+
+    def run(self, method, request, func, *args):
+        if not self.active.acquire(blocking=False):
+            self.counters['skipped_busy'] += 1
+            return func(*args)
+        try:
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                self.record(method, request, profile, time.perf_counter() - start)
+        finally:
+            self.active.release()
+
+    def record(self, method, request, profile, elapsed):
+        profile.create_stats()
+        with self.lock:
+            self.counters['profiled'] += 1
+            if method in self.by_method:
+                self.by_method[method].add(profile)
+            else:
+                self.by_method[method] = pstats.Stats(profile)
+            if len(self.slowest) < self.keep_slowest or self.slowest[0][0] < elapsed:
+                # Arguments without credentials, the profile is rendered only for the requests that are kept
+                args = {k: v for k, v in request.items() if k not in ('password', 'session_token', 'token')}
+                item = (elapsed, self.counters['profiled'], method, args, time.time(), profile)
+                if len(self.slowest) < self.keep_slowest:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heapreplace(self.slowest, item)
+
+    @staticmethod
+    def render(stats, limit=40):
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    @staticmethod
+    def file_name(method):
+        # Method names are what clients sent, they must not point outside the dump directory
+        return re.sub(r'[^\w-]', '_', str(method))[:100] or '_'
+
+    def dump(self):
+        # <directory>/<time>-<pid>/: <method>.prof for pstats/snakeviz, <method>.txt and slowest.txt to read
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            by_method = dict(self.by_method)
+            slowest = sorted(self.slowest, reverse=True)
+            counters = dict(self.counters)
+        files = []
+        for method, stats in by_method.items():
+            name = self.file_name(method)
+            stats.dump_stats(os.path.join(path, f"{name}.prof"))
+            with open(os.path.join(path, f"{name}.txt"), 'w') as f:
+                f.write(f"{method}: {stats.total_calls} calls, {stats.total_tt:.3f} s\n")
+                f.write(self.render(stats))
+            files += [f"{name}.prof", f"{name}.txt"]
+        with open(os.path.join(path, 'slowest.txt'), 'w') as f:
+            f.write(f"profiled {counters['profiled']} requests since "
+                    f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}\n\n")
+            for elapsed, _, method, args, at, profile in slowest:
+                f.write(f"=== {method} {elapsed * 1000:.1f} ms at "
+                        f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at))} {args}\n")
+                f.write(self.render(pstats.Stats(profile), limit=25))
+                f.write('\n')
+        files.append('slowest.txt')
+        logger.info(f"Profiles dumped to {path}")
+        return {'path': path, 'files': files}
+
+    def status(self):
+        with self.lock:
+            return {'enabled': self.enabled, 'percent': self.percent, 'methods': sorted(self.methods),
+                    'methods_profiled': sorted(self.by_method), **self.counters}
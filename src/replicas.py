@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+
+import pg
+
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+
+def parse_lsn(lsn):
+    # '16/B374D848' -> position in WAL as a number, so that positions can be compared
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class Replica:
+    def __init__(self, params):
+        self.params = params
+        self.name = f"{params.get('host')}:{params.get('port')}"
+        self._db = None
+        self.healthy = False
+        self.lag = None
+        self.replay_lsn = 0
+        self.reads = 0
+        # One connection shared by the worker threads, used by one of them at a time
+        self.lock = threading.Lock()
+
+    def query(self, query):
+        with self.lock:
+            self.reads += 1
+            if self._db is None:
+                self._db = pg.DB(**self.params)
+            return self._db.query(query).dictresult()
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                try:
+                    self._db.close()
+                except pg.Error:
+                    pass
+                self._db = None
+
+
+class ReplicaPool:
+    # Read-only queries go to streaming replicas that are at most max_lag seconds behind the primary.
+    # A key (user id) that wrote to the primary reads from the primary until a replica has replayed
+    # that write, so users always see their own changes. Replica state is refreshed by a background
+    # thread on its own connections every check_interval seconds.
+
+    def __init__(self, endpoints, max_lag, check_interval):
+        self.replicas = [Replica(params) for params in endpoints]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.written = {}
+        # Highest write position forgotten from self.written, a replica has to be past it to be read from
+        self.forgotten = 0
+        self.lock = threading.Lock()
+        self.next = 0
+        self.primary_reads = 0
+        self.monitors = {}
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='replica-check')
+        self.thread.daemon = True
+
+    @property
+    def enabled(self):
+        return len(self.replicas) != 0
+
+    def start(self):
+        if self.enabled:
+            self.check()
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        for replica in self.replicas:
+            replica.close()
+
+    def run(self):
+        while not self.stopped:
+            time.sleep(self.check_interval)
+            self.check()
+        for monitor in self.monitors.values():
+            monitor.close()
+
+    def check(self):
+        monitors = self.monitors
+        for replica in self.replicas:
+            try:
+                if replica.name not in monitors:
+                    monitors[replica.name] = pg.DB(**replica.params)
+                # Replay timestamp stands still when the primary is idle, so a replica that has replayed
+                # everything it received is not lagging no matter how old the last transaction is
+                row = monitors[replica.name].query("""
+                    select pg_is_in_recovery() as standby,
+                           pg_last_wal_replay_lsn()::text as replay_lsn,
+                           case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+                                else extract(epoch from now() - pg_last_xact_replay_timestamp())
+                           end as lag""").dictresult()[0]
+            except pg.Error as e:
+                logger.warning(f"Replica {replica.name} is unavailable: {e}")
+                monitor = monitors.pop(replica.name, None)
+                if monitor is not None:
+                    monitor.close()
+                replica.healthy = False
+                continue
+            if not row['standby']:
+                logger.warning(f"{replica.name} is not a standby, not reading from it")
+                replica.healthy = False
+                continue
+            replica.lag = float(row['lag'] or 0)
+            replica.replay_lsn = parse_lsn(row['replay_lsn']) if row['replay_lsn'] else 0
+            healthy = replica.lag <= self.max_lag
+            if healthy != replica.healthy:
+                logger.info(f"Replica {replica.name} is {'back' if healthy else 'lagging'}, lag {replica.lag:.1f} s")
+            replica.healthy = healthy
+        self._forget_replayed()
+
+    def _forget_replayed(self):
+        # Only replicas that are read from count: a dead one would keep every writer on the primary forever.
+        # One that comes back is not read from until it has replayed everything forgotten meanwhile.
+        healthy = [replica.replay_lsn for replica in self.replicas if replica.healthy]
+        if len(healthy) == 0:
+            return
+        replayed = min(healthy)
+        with self.lock:
+            for key in [key for key, lsn in self.written.items() if lsn <= replayed]:
+                self.forgotten = max(self.forgotten, self.written.pop(key))
+
+    def wrote(self, key, lsn):
+        with self.lock:
+            self.written[key] = max(lsn, self.written.get(key, 0))
+
+    def choose(self, key=None):
+        # Replica to read from, None means the primary
+        with self.lock:
+            written = max(self.written.get(key, 0), self.forgotten)
+            candidates = [replica for replica in self.replicas if replica.healthy and written <= replica.replay_lsn]
+            if len(candidates) == 0:
+                self.primary_reads += 1
+                return None
+            self.next = (self.next + 1) % len(candidates)
+            return candidates[self.next]
+
+    def failed(self, replica, e):
+        logger.warning(f"Read from replica {replica.name} failed, using primary: {e}")
+        replica.healthy = False
+        replica.close()
+
+    def stats(self):
+        return {'primary_reads': self.primary_reads,
+                'pending_writers': len(self.written),
+                'replicas': [{'name': replica.name, 'healthy': replica.healthy, 'lag': replica.lag,
+                              'reads': replica.reads} for replica in self.replicas]}
@@ -5,7 +5,12 @@ from datetime import datetime, timedelta
 import pg
 import datetime as dt
 
+import src.cache
+import src.catalog
+import src.invalidation
 import src.lms_data_loader
+import src.replicas
+import src.write_behind
 from src import settings
 from src.utils import debug
 import threading
@@ -16,8 +21,8 @@ def dump_exists(path):
     return os.path.isfile(path) and os.path.isfile(path)
 
 
-def dbconnect() -> pg.DB:
-    return pg.DB(**settings.db_connection)
+def dbconnect(params=None) -> pg.DB:
+    return pg.DB(**(params or settings.db_connection))
 
 
 logger = logging.getLogger(settings.logger_name)
@@ -35,32 +40,172 @@ def synchronized(func):
 
 class Server:
 
-    def __init__(self):
-        logger.info("Connecting to DB")
-        self._connection = dbconnect()
-        logger.info("Connected")
-        logger.info("Creating LMS loaders")
-        self.student_loader = src.lms_data_loader.LmsStudentLoader(server=self)
-        self.building_loader = src.lms_data_loader.LmsBuildingLoader(server=self)
-        self.auditorium_loader = src.lms_data_loader.LmsAuditoriumLoader(self.building_loader, server=self)
-        self.teacher_loader = src.lms_data_loader.LmsTeacherLoader(server=self)
-        self.lesson_loader = src.lms_data_loader.LmsLessonLoader(self.auditorium_loader, self.teacher_loader,
-                                                                 server=self)
-        logger.info("Created")
+    def __init__(self, invalidation=False, worker=None):
+        # Nothing here touches DB or RUZ, so the frontend can bind its port right away.
+        # DB connection and loaders are created on first use, catalog is loaded by warm_up().
+        self._db = None
+        self._db_lock = threading.Lock()
+        # Idle connections for streamed queries by connection parameters (None is the primary)
+        self._stream_connections = {}
+        self._stream_lock = threading.Lock()
+        self._loaders = None
+        self._loaders_lock = threading.Lock()
+        self._pipeline = None
+        self._pipeline_lock = threading.Lock()
+        self.negative_cache = src.cache.NegativeCache(**settings.negative_cache)
+        self.catalog = src.catalog.Catalog()
+        self.catalog_ready = threading.Event()
+        self.warm_up_error = None
+        self.use_invalidation = invalidation
+        self.invalidation = None
+        self.replicas = src.replicas.ReplicaPool(settings.read_replicas, **settings.replica)
+        self._workload = None
+        self.write_behind = None
+        if settings.write_behind['enabled']:
+            # Only the local log is read here: changes a crash left in it are pending from the start,
+            # newer ones coalesce over them and reads wait for them
+            conf = settings.write_behind
+            root, ext = os.path.splitext(conf['log'])
+            path = conf['log'] if worker is None else f"{root}.{worker}{ext}"
+            self.write_behind = src.write_behind.WriteBehind(dbconnect, path, conf['flush_interval'],
+                                                             conf['batch_size'], on_flush=self._flushed)
+
+    def warm_up(self):
+        # May be called again after a failure, every step is done once
+        if self.use_invalidation and self.invalidation is None:
+            # Several server processes share DB, each of them has to hear about the others' writes.
+            # Started before the catalog is loaded, so that nothing written meanwhile is missed.
+            invalidation = src.invalidation.InvalidationBus(dbconnect)
+            invalidation.subscribe('written', self._written_elsewhere)
+            invalidation.subscribe('missing', self._missing_elsewhere)
+            invalidation.subscribe('reconnected', self._reconnected)
+            invalidation.start()
+            self.invalidation = invalidation
+        db = dbconnect()
+        try:
+            self.catalog.load(db)
+        finally:
+            db.close()
+        self.catalog_ready.set()
+        self.replicas.start()
+        if self.write_behind is not None:
+            self.write_behind.start()
+        self.warm_up_error = None
+        logger.info("Server is warmed up")
+
+    @property
+    def _connection(self):
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    logger.info("Connecting to DB")
+                    self._db = dbconnect()
+                    logger.info("Connected")
+        return self._db
+
+    def _loader(self, name):
+        if self._loaders is None:
+            with self._loaders_lock:
+                if self._loaders is None:
+                    logger.info("Creating LMS loaders")
+                    building_loader = src.lms_data_loader.LmsBuildingLoader(server=self)
+                    auditorium_loader = src.lms_data_loader.LmsAuditoriumLoader(building_loader, server=self)
+                    teacher_loader = src.lms_data_loader.LmsTeacherLoader(server=self)
+                    self._loaders = {
+                        'student': src.lms_data_loader.LmsStudentLoader(server=self),
+                        'building': building_loader,
+                        'auditorium': auditorium_loader,
+                        'teacher': teacher_loader,
+                        'lesson': src.lms_data_loader.LmsLessonLoader(auditorium_loader, teacher_loader, server=self),
+                    }
+                    logger.info("Created")
+        return self._loaders[name]
+
+    @property
+    def student_loader(self):
+        return self._loader('student')
+
+    @property
+    def building_loader(self):
+        return self._loader('building')
+
+    @property
+    def auditorium_loader(self):
+        return self._loader('auditorium')
+
+    @property
+    def teacher_loader(self):
+        return self._loader('teacher')
+
+    @property
+    def lesson_loader(self):
+        return self._loader('lesson')
+
+    def _read(self, query, user_id=None, primary=False):
+        # Read-only query, goes to a replica if there is one that has everything user_id wrote
+        replica = None if primary else self.replicas.choose(user_id)
+        if replica is not None:
+            try:
+                return replica.query(query)
+            except pg.Error as e:
+                self.replicas.failed(replica, e)
+        return self._connection.query(query).dictresult()
+
+    def _stream_params(self, user_id=None):
+        replica = self.replicas.choose(user_id)
+        return None if replica is None else replica.params
+
+    def _wrote(self, *user_ids, db=None):
+        # Following reads of user_ids stay on the primary until replicas replay this write
+        if self.replicas.enabled:
+            lsn = (db or self._connection).query("select pg_current_wal_lsn()::text").getresult()[0][0]
+            for user_id in user_ids:
+                self.replicas.wrote(user_id, src.replicas.parse_lsn(lsn))
+
+    def _flush_pending(self):
+        # Reads of deadlines and estimates see everything that was acknowledged
+        if self.write_behind is not None:
+            self.write_behind.flush()
+
+    def _flushed(self, db, deadline_ids, task_ids, user_ids):
+        # Called by write-behind on its own connection after a batch is committed
+        if len(deadline_ids) != 0:
+            self.notify_written('deadlines', [{'id': x} for x in deadline_ids])
+        if len(task_ids) != 0:
+            self.notify_written('task_time', [{'id': x} for x in task_ids])
+        self._wrote(*user_ids, db=db)
 
     @synchronized
     def get_user_info(self, user_id=None, user_name=None):
-        if user_id:
-            query = f"""SELECT * FROM students WHERE id = {user_id} LIMIT 1"""
-        elif user_name:
-            query = f"""SELECT * FROM find_users('{user_name}', '{user_name}', '{user_name}')"""
-        else:
-            raise KeyError("Neither user_id nor user_name are specified")
-
+        query = self._user_info_query(user_id, user_name)
+        if self.replicas.enabled:
+            result = self._read(query, user_id)
+            if len(result) != 0:
+                return result
+        # Not in DB (or not replicated yet): primary, then RUZ
         result = self.get_simple_data(query, self.student_loader, user_name)
 
         return result
 
+    @staticmethod
+    def _user_info_query(user_id=None, user_name=None):
+        if user_id:
+            return f"""SELECT * FROM students WHERE id = {user_id} LIMIT 1"""
+        elif user_name:
+            return f"""SELECT * FROM find_users('{user_name}', '{user_name}', '{user_name}')"""
+        raise KeyError("Neither user_id nor user_name are specified")
+
+    def stream_user_info(self, user_id=None, user_name=None, chunk_size=None):
+        query = self._user_info_query(user_id, user_name)
+        empty = True
+        for chunk in self.stream_query(query, chunk_size, self._stream_params(user_id)):
+            empty = False
+            yield chunk
+        if empty:
+            result = self.get_simple_data(query, self.student_loader, user_name)
+            if len(result) != 0:
+                yield result
+
     @synchronized
     def get_timetable(self, user_id, time_start=None, time_end=None):
         logger.debug(f"Entering with parameters user_id = {user_id}, time_start = {time_start}, time_end = {time_end}")
@@ -68,26 +213,197 @@ class Server:
             time_start = datetime.now() - timedelta(days=14)
         if not time_end:
             time_end = datetime.now() + timedelta(days=14)
-        query = f"""select *
-                    from get_timetable_by_user_id({user_id}) timetable
-                    where timetable.date between '{time_start}' and '{time_end}';"""
-        result = self._connection.query(query).dictresult()
+        result = self._query_timetable(user_id, time_start, time_end)
         logger.debug(result)
+        if len(result) == 0 and self.replicas.enabled:
+            # Lessons may have been loaded a moment ago and not replicated yet, don't go to RUZ again
+            result = self._query_timetable(user_id, time_start, time_end, primary=True)
         if len(result) == 0:
             logger.debug("Not found: call LessonLoader")
-            start = time_start.date()
-            end = time_end.date()
-            _result = self.lesson_loader.load_lessons(user_id, start, end)
-            self.lesson_loader.add_to_db(lessons=_result)
+            self.load_lessons(user_id, time_start.date(), time_end.date())
             logger.debug("Retry query")
-            result = self._connection.query(query).dictresult()
+            result = self._query_timetable(user_id, time_start, time_end, primary=True)
             logger.debug(result)
         return result
 
+    def _query_timetable(self, user_id, time_start, time_end, primary=False):
+        if settings.denormalized_timetable:
+            return self._read(self._contingent_timetable_query(user_id, time_start, time_end), user_id, primary)
+        if not self.catalog_ready.is_set():
+            # Catalog is still loading after startup, let DB do the joins meanwhile
+            return self._read(self._joined_timetable_query(user_id, time_start, time_end), user_id, primary)
+        rows = self._read(self._timetable_query(user_id, time_start, time_end), user_id, primary)
+        return self.catalog.enrich_lessons(self._connection, rows)
+
+    @staticmethod
+    def _joined_timetable_query(user_id, time_start, time_end):
+        return f"""select *
+                   from get_timetable_by_user_id({user_id}) timetable
+                   where timetable.date between '{time_start}' and '{time_end}'"""
+
+    @staticmethod
+    def _contingent_timetable_query(user_id, time_start, time_end):
+        # Rows are precomputed per contingent, so this is an index range scan for each contingent of the student
+        return f"""select stc.student_id as user_id, students.first_name, tt.lesson_time_id, tt.date, tt.start,
+                          tt."end", tt.building_addr, tt.lesson_type, tt.flow, tt.course_short_name,
+                          tt.course_full_name
+                   from students_to_contingents stc
+                          join students on students.id = stc.student_id
+                          join contingent_timetable tt on tt.contingent_id = stc.contingent_id
+                   where stc.student_id = {user_id} and tt.date between '{time_start}' and '{time_end}'
+                   order by tt.date, tt.lesson_time_id"""
+
+    @staticmethod
+    def _timetable_query(user_id, time_start, time_end):
+        # Only lesson rows are read from DB, reference tables are joined in process by catalog.enrich_lessons
+        return f"""select students.id as user_id, students.first_name, lesson.lesson_time_id, lesson.date,
+                          lesson.lesson_type, lesson.course_id, lesson.auditorium_id, lesson.contingent_id
+                   from students
+                          join students_to_contingents stc on students.id = stc.student_id
+                          join lesson on stc.contingent_id = lesson.contingent_id
+                   where students.id = {user_id} and lesson.date between '{time_start}' and '{time_end}'
+                   order by lesson.date, lesson.lesson_time_id"""
+
+    def stream_timetable(self, user_id, time_start=None, time_end=None, chunk_size=None):
+        if not time_start:
+            time_start = datetime.now() - timedelta(days=14)
+        if not time_end:
+            time_end = datetime.now() + timedelta(days=14)
+        enrich = False
+        if settings.denormalized_timetable:
+            query = self._contingent_timetable_query(user_id, time_start, time_end)
+        elif self.catalog_ready.is_set():
+            query = self._timetable_query(user_id, time_start, time_end)
+            enrich = True
+        else:
+            query = self._joined_timetable_query(user_id, time_start, time_end)
+        empty = True
+        for chunk in self.stream_query(query, chunk_size, self._stream_params(user_id)):
+            empty = False
+            yield self.enrich_lessons(chunk) if enrich else chunk
+        if empty:
+            # Nothing in DB yet, so the regular path has to go to RUZ and the result is small anyway
+            result = self.get_timetable(user_id, time_start, time_end)
+            if len(result) != 0:
+                yield result
+
+    @synchronized
+    def enrich_lessons(self, rows):
+        # catalog may need to reload missing rows through the shared connection
+        return self.catalog.enrich_lessons(self._connection, rows)
+
+    @property
+    def pipeline(self):
+        # One pipeline for the server's lifetime, so a timetable cache miss doesn't start thread pools
+        # and DB connections of its own
+        if self._pipeline is None:
+            with self._pipeline_lock:
+                if self._pipeline is None:
+                    import src.lms_pipeline
+                    self._pipeline = src.lms_pipeline.LmsPipeline(server=self)
+        return self._pipeline
+
+    def run_pipeline(self, jobs):
+        # Loads jobs through the pipeline's own DB connections, the shared one is not touched
+        return self.pipeline.submit(jobs)
+
+    def load_lessons(self, user_id, begin, end):
+        import src.lms_pipeline
+        return self.run_pipeline([src.lms_pipeline.LessonJob(user_id, begin, end)])
+
+    def notify_written(self, table, rows):
+        rows = list(rows)
+        if len(rows) == 0:
+            return
+        self.catalog.update(table, rows)
+        # Something new in the table may be what an earlier search didn't find in RUZ
+        self.negative_cache.discard(table, rows)
+        ids = [row['id'] for row in rows if row.get('id') is not None]
+        if self._workload is not None:
+            self._workload.written(table, ids or None)
+        if self.invalidation is not None:
+            self.invalidation.publish('written', ids=ids or None, table=table)
+
+    def _written_elsewhere(self, db, message):
+        if message['table'] in src.catalog.Catalog.tables:
+            self.catalog.reload(db, message['table'], message.get('ids'))
+        if message.get('ids') is None:
+            # Bulk write, anything may have appeared
+            self.negative_cache.clear(message['table'])
+        elif self.negative_cache.holds(message['table']):
+            ids = [int(id) for id in message['ids']]
+            rows = db.query_formatted(f"select * from {message['table']} where id = any(%s::bigint[])",
+                                      (ids,)).dictresult()
+            self.negative_cache.discard(message['table'], rows)
+        if self._workload is not None:
+            self._workload.written(message['table'], message.get('ids'))
+
+    def _reconnected(self, db, message):
+        # Writes of other processes may have been missed meanwhile, reload everything they could have changed
+        self.catalog.load(db)
+        self.negative_cache.clear()
+        if self._workload is not None:
+            for table in ('deadlines', 'task_time', 'students_to_contingents'):
+                self._workload.written(table)
+
+    def remember_missing(self, table, term):
+        self.negative_cache.add(table, term)
+        if self.invalidation is not None:
+            self.invalidation.publish('missing', table=table, term=term)
+
+    def _missing_elsewhere(self, db, message):
+        self.negative_cache.add(message['table'], message['term'])
+
+    def close(self):
+        if self.invalidation is not None:
+            self.invalidation.stop()
+        self.replicas.stop()
+        if self.write_behind is not None:
+            self.write_behind.stop()
+        if self._pipeline is not None:
+            self._pipeline.close()
+        if self._db is not None:
+            self._db.close()
+        with self._stream_lock:
+            for idle in self._stream_connections.values():
+                for db in idle:
+                    db.close()
+            self._stream_connections = {}
+
+    def get_stats(self):
+        return {'ready': self.catalog_ready.is_set(), 'warm_up_error': self.warm_up_error,
+                'negative_cache': self.negative_cache.stats(),
+                'catalog': self.catalog.size(), 'reads': self.replicas.stats(),
+                'workload': None if self._workload is None else self._workload.stats(),
+                'write_behind': None if self.write_behind is None else self.write_behind.stats()}
+
+    @property
+    def workload(self):
+        # NumPy is only imported and deadlines only loaded when somebody asks for analytics
+        if self._workload is None:
+            import src.workload
+            self._workload = src.workload.WorkloadAnalytics(**settings.workload)
+        return self._workload
+
+    @synchronized
+    def get_workload(self, user_id, weeks=None):
+        self._flush_pending()
+        self.workload.refresh(self._connection)
+        result = self.workload.student(user_id, weeks)
+        self.catalog.ensure(self._connection, result['contingents'], {'contingent_id': 'contingents'})
+        self.catalog.ensure(self._connection, result['courses'], {'course_id': 'learning_courses'})
+        for row in result['contingents']:
+            contingent = self.catalog.get('contingents', row['contingent_id'])
+            row['flow'] = None if contingent is None else contingent.contingent_name
+        for row in result['courses']:
+            course = self.catalog.get('learning_courses', row['course_id'])
+            row['course_name'] = None if course is None else course.shortname
+        return result
+
     @synchronized
     def get_contingent_by_user_id(self, user_id):
         query = f"select * from get_contingent_id_by_user_id({user_id})"
-        return self._connection.query(query).dictresult()
+        return self._read(query, user_id)
 
     @synchronized
     def get_deadlines(self, user_id, time_start=None, time_end=None):
@@ -96,24 +412,66 @@ class Server:
         if not time_end:
             time_end = datetime.now() + timedelta(days=365)
         logger.debug(f"Entering with parameters user_id = {user_id}, time_start = {time_start}, time_end = {time_end}")
-        query = f"""select * from get_deadlines_by_id({user_id}, '{time_start}', '{time_end}')"""
+        self._flush_pending()
+        query = self._deadlines_query(user_id, time_start, time_end)
         logger.debug(f"Sending query {query}")
-        result = self._connection.query(query).dictresult()
+        result = self._read(query, user_id)
         debug(result)
         return result
 
+    @staticmethod
+    def _deadlines_query(user_id, time_start, time_end):
+        return f"""select * from get_deadlines_by_id({user_id}, '{time_start}', '{time_end}')"""
+
+    def stream_deadlines(self, user_id, time_start=None, time_end=None, chunk_size=None):
+        if not time_start:
+            time_start = datetime.now() - timedelta(days=7)
+        if not time_end:
+            time_end = datetime.now() + timedelta(days=365)
+        self._flush_pending()
+        return self.stream_query(self._deadlines_query(user_id, time_start, time_end), chunk_size,
+                                 self._stream_params(user_id))
+
     @synchronized
     def create_deadilne(self, user_id, contingent_id, time, weight, name, desc):
         debug(
             f"Entering with paraters user_id = {user_id}, time = {time}, weight = {weight}, name = {name}, desc = {desc}")
+        if self.write_behind is not None:
+            return self._create_deadline_behind(user_id, contingent_id, time, weight, name, desc)
         query = f"""select insert_deadline({user_id}, {contingent_id}, '{time}', {weight}, '{name}', '{desc}')"""
         self._connection.query(query)
         res = self._connection.query("select lastval() as id").dictresult()[0]
         logger.debug(f"Inserted: {res}")
+        self.notify_written('deadlines', [res])
+        self._wrote(user_id)
         return res
 
-    @synchronized
+    def _create_deadline_behind(self, user_id, contingent_id, time, weight, name, desc):
+        # Id is taken from the sequence right away, so the client gets it before the row is written.
+        # Time and contingent are checked in the same round trip, so an acknowledged deadline can be written.
+        row = self._connection.query_formatted(
+            """select nextval(pg_get_serial_sequence('deadlines', 'id')) as id, %s::timestamp as time,
+                      exists(select 1 from contingents where id = %s) as known""",
+            (time, contingent_id)).dictresult()[0]
+        if not row['known']:
+            raise Exception(f'Unknown contingent {contingent_id}')
+        self.write_behind.create_deadline(row['id'], user_id, contingent_id, str(row['time']), float(weight),
+                                          name, desc)
+        return {'id': row['id']}
+
     def change_deadline_estimate(self, user_id, deadline_id, new_value):
+        # Not synchronized with write-behind on: concurrent estimates share one fsync of the log
+        if self.write_behind is not None:
+            # A batch would reject an estimate of a deadline that doesn't exist after it was acknowledged.
+            # Write-behind is asked first: a deadline it is writing right now is in DB once it's not there
+            if not self.write_behind.has_deadline(int(deadline_id)) and not self._deadline_exists(deadline_id):
+                raise Exception(f'Unknown deadline {deadline_id}')
+            self.write_behind.set_estimate(user_id, deadline_id, float(new_value))
+        else:
+            self._write_deadline_estimate(user_id, deadline_id, new_value)
+
+    @synchronized
+    def _write_deadline_estimate(self, user_id, deadline_id, new_value):
         query = f"select id from task_time where student_id={user_id} and deadline_id={deadline_id}"
         logger.debug(f"Query {query}")
         task_ids = [x['id'] for x in self._connection.query(query).dictresult()]
@@ -127,9 +485,29 @@ class Server:
         query = f"update task_time set estimated_time='{new_value} hours' where id in ({', '.join([str(x) for x in task_ids])})"
         logger.debug(f"Update: {query}")
         self._connection.query(query)
+        self.notify_written('task_time', [{'id': x} for x in task_ids])
+        self._wrote(user_id)
 
-    @synchronized
     def change_deadline_real(self, user_id, deadline_id, new_value):
+        if self.write_behind is not None:
+            if not self.write_behind.has_estimate(user_id, deadline_id) and not self._has_task_time(user_id, deadline_id):
+                raise Exception('You should previously set estimated time')
+            self.write_behind.set_real(user_id, deadline_id, float(new_value))
+        else:
+            self._write_deadline_real(user_id, deadline_id, new_value)
+
+    @synchronized
+    def _deadline_exists(self, deadline_id):
+        query = "select 1 from deadlines where id = %s"
+        return len(self._connection.query_formatted(query, (deadline_id,)).getresult()) != 0
+
+    @synchronized
+    def _has_task_time(self, user_id, deadline_id):
+        query = f"select 1 from task_time where student_id={user_id} and deadline_id={deadline_id}"
+        return len(self._connection.query(query).getresult()) != 0
+
+    @synchronized
+    def _write_deadline_real(self, user_id, deadline_id, new_value):
         query = f"select id from task_time where student_id={user_id} and deadline_id={deadline_id}"
         logger.debug(f"Query {query}")
         task_ids = [x['id'] for x in self._connection.query(query).dictresult()]
@@ -139,6 +517,8 @@ class Server:
         query = f"update task_time set real_time='{new_value} hours' where id in ({', '.join([str(x) for x in task_ids])})"
         logger.debug(f"Update: {query}")
         self._connection.query(query)
+        self.notify_written('task_time', [{'id': x} for x in task_ids])
+        self._wrote(user_id)
         pass
 
     @synchronized
@@ -150,11 +530,18 @@ class Server:
         logger.debug(f"Result: {result}")
 
         if len(result) == 0 and lms_data_loader is not None and term is not None:
+            if self.negative_cache.contains(lms_data_loader.table, term):
+                logger.debug(f"{lms_data_loader.table} with term {term} is known to be missing in RUZ")
+                return result
+
             logger.debug(f"Got empty result, try use {type(lms_data_loader)} with term {term}")
 
             try:
                 objs = lms_data_loader.load_term(term)
                 logger.debug(f"Found {len(objs)} items: {objs}")
+                if len(objs) == 0:
+                    self.remember_missing(lms_data_loader.table, term)
+                    return result
                 lms_data_loader.add_to_db(objs)
                 logger.debug("Saved to db")
                 return [objs[key] for key in objs]
@@ -163,6 +550,59 @@ class Server:
 
         return result
 
+    def stream_query(self, query, chunk_size=None, params=None):
+        # Server-side cursor lives in its own transaction, so it gets its own connection
+        # instead of holding the shared one (and its locks) while the client reads the frames.
+        # Connections are taken from a small pool, so that short streams don't pay for a new backend.
+        # params are connection parameters of a read replica, primary if None
+        if chunk_size is None:
+            chunk_size = settings.stream_chunk_size
+        logger.debug(f"Streaming query {query} in chunks of {chunk_size}")
+        db = self._stream_connection(params)
+        reusable = False
+        try:
+            db.begin()
+            db.query(f"declare stream_cursor no scroll cursor for {query}")
+            while True:
+                chunk = db.query(f"fetch forward {int(chunk_size)} from stream_cursor").dictresult()
+                logger.debug(f"Fetched {len(chunk)} rows")
+                if len(chunk) != 0:
+                    yield chunk
+                if len(chunk) < chunk_size:
+                    break
+            db.query("close stream_cursor")
+            db.end()
+            reusable = True
+        finally:
+            if not reusable:
+                # Client went away mid-stream or the query failed, the connection is still usable after rollback
+                try:
+                    db.rollback()
+                    reusable = True
+                except pg.Error:
+                    pass
+            self._release_stream_connection(params, db, reusable)
+
+    @staticmethod
+    def _stream_key(params):
+        return None if params is None else tuple(sorted(params.items()))
+
+    def _stream_connection(self, params):
+        with self._stream_lock:
+            idle = self._stream_connections.get(self._stream_key(params))
+            if idle:
+                return idle.pop()
+        return dbconnect(params)
+
+    def _release_stream_connection(self, params, db, reusable):
+        if reusable:
+            with self._stream_lock:
+                idle = self._stream_connections.setdefault(self._stream_key(params), [])
+                if len(idle) < settings.stream_pool_size:
+                    idle.append(db)
+                    return
+        db.close()
+
     @synchronized
     def get_building(self, id=None, building_name=None, building_addr=None):
         query = None
@@ -246,6 +686,20 @@ class Server:
         logger.debug(f"Insert: {insert_query}")
         self._connection.query(insert_query)
 
+    @synchronized
+    def revoke_token(self, token, expires):
+        # Expired tokens are refused anyway, their rows are deleted along the way
+        self._connection.query("delete from revoked_session_tokens where expires < now()")
+        self._connection.query_formatted("""insert into revoked_session_tokens (token, expires)
+                                            values (%s, to_timestamp(%s)) on conflict do nothing""",
+                                         (token, expires))
+
+    @synchronized
+    def token_revoked(self, token):
+        # Always the primary: a token revoked a moment ago may not be on replicas yet
+        return len(self._connection.query_formatted("select 1 from revoked_session_tokens where token = %s",
+                                                    (token,)).getresult()) != 0
+
     @synchronized
     def check_password(self, login, password):
         if re.match('^[a-z]*$', login) is None:
@@ -5,19 +5,29 @@ import logging
 import time
 import threading
 import json
+import hmac
+import secrets
+import concurrent.futures
 
+from src import settings
+from src.admission import Rejected, RateLimiter, WorkQueue
+from src.heartbeat import IdleReaper, SessionTokens
+from src.profiling import RequestProfiler
 from src.server_backend import Server
 
 
 class Session:
     def __init__(self, conn: socket.socket, addr):
         self.conn = conn
-        self.conn.settimeout(600)
+        # Whole packet must arrive within timeout once it started, silence between packets
+        # is limited by IdleReaper instead
+        self.timeout = settings.session['packet_timeout']
+        self.conn.settimeout(self.timeout)
         self.client_addr = addr
-        self.timeout = 600
         self.thread = None
         self.server = None
         self.user_id = None
+        self.token = None
 
     def send_packet(self, obj):
         bdata = json.dumps(obj, default=str).encode()
@@ -31,7 +41,10 @@ class Session:
         bdata = bytes()
         while len(bdata) < size and 0 < time_left[0]:
             start = time.time()
-            bdata += self.conn.recv(size - len(bdata))
+            chunk = self.conn.recv(size - len(bdata))
+            if len(chunk) == 0:
+                raise ConnectionResetError('Connection closed by peer')
+            bdata += chunk
             time_left[0] -= time.time() - start
 
         if len(bdata) < size:
@@ -39,9 +52,18 @@ class Session:
         return bdata
 
     def recv_packet(self):
-        time_left = [self.timeout]
         logging.debug(f'Waiting header from {self.client_addr}')
-        bsize = self.recvall(4, time_left)
+        while True:
+            try:
+                first = self.conn.recv(4)
+                break
+            except socket.timeout:
+                # Idle connection, it's up to the reaper to decide when it has been idle for too long
+                continue
+        if len(first) == 0:
+            raise ConnectionResetError('Connection closed by peer')
+        time_left = [self.timeout]
+        bsize = first + self.recvall(4 - len(first), time_left)
         size = int.from_bytes(bsize, byteorder='big')
         logging.debug(f'Receiving packet of size {size} from {self.client_addr}')
         bdata = self.recvall(size, time_left)
@@ -52,6 +74,13 @@ class Session:
         logging.info('Closing connection from ' + str(self.client_addr))
         self.conn.close()
 
+    def abort(self):
+        # Called from another thread: wakes up recv in the session thread, which then ends the session
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def assert_not_logged_in(self):
         if self.user_id is not None:
             raise Exception('You are logged in')
@@ -62,21 +91,46 @@ class Session:
         return self.user_id
 
 
+def listening_socket(host: str, port: int, reuse_port=False) -> socket.socket:
+    sock = socket.socket()
+    if reuse_port:
+        # Every worker binds its own socket to the same port and the kernel balances connections between them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen()
+    return sock
+
+
 class TCPServer:
-    def __init__(self, host: str, port: int) -> None:
-        logging.debug(f"Starting backend server")
-        self.srv = Server()
-        logging.debug(f"Backend server started")
+    def __init__(self, host: str, port: int, sock: socket.socket = None, reuse_port=False, invalidation=False,
+                 worker=None) -> None:
         self.host = host
         self.port = port
-        self.control_sock = socket.socket()
-        self.control_sock.bind((self.host, self.port))
+        if sock is None:
+            sock = listening_socket(self.host, self.port, reuse_port)
+        self.control_sock = sock
         self.control_sock.settimeout(5)
-        self.control_sock.listen()
-        print("Listen", self.host, self.port)
+        logging.debug(f"Starting backend server")
+        self.srv = Server(invalidation=invalidation, worker=worker)
         self.shutdown = None
+        # Port is already bound, so clients are accepted (and served from DB) while the backend warms up
+        self.warm_up_thread = threading.Thread(target=self.warm_up, name='warm-up')
+        self.warm_up_thread.daemon = True
+        self.warm_up_thread.start()
+        print("Listen", self.host, self.port)
         self.sessions = set()
         self.sessions_lock = threading.Lock()
+        conf = settings.admission
+        self.user_limiter = RateLimiter(conf['user_rate'], conf['user_burst'])
+        self.ip_limiter = RateLimiter(conf['ip_rate'], conf['ip_burst'])
+        self.work_queue = WorkQueue(conf['workers'], conf['queue_size'])
+        self.admission_counters = {'rejected_sessions': 0, 'rate_limited': 0, 'shed': 0, 'deadline_exceeded': 0}
+        self.reaper = IdleReaper(settings.session['idle_timeout'], settings.session['reaper_tick'])
+        self.reaper.start()
+        if settings.session['secret'] is None:
+            settings.session['secret'] = secrets.token_hex(32)
+        self.tokens = SessionTokens(settings.session['secret'], settings.session['resume_ttl'], store=self.srv)
+        self.profiler = RequestProfiler(**settings.profiling)
 
         def term_signal_handler(sig, arg):
             print("Got signal", sig)
@@ -87,6 +141,24 @@ class TCPServer:
 
         signal.signal(signal.SIGTERM, term_signal_handler)
         signal.signal(signal.SIGINT, term_signal_handler)
+        # kill -USR1 switches profiling on and off, kill -USR2 dumps what has been collected
+        signal.signal(signal.SIGUSR1, lambda sig, arg: self.profiler.toggle())
+        signal.signal(signal.SIGUSR2, lambda sig, arg: threading.Thread(target=self.profiler.dump).start())
+
+    def warm_up(self):
+        # Retried until it succeeds: without it the catalog is never used, and invalidations,
+        # replica checks and write-behind flushes never start
+        delay = 1
+        while not self.shutdown:
+            try:
+                self.srv.warm_up()
+                logging.debug(f"Backend server started")
+                return
+            except Exception as e:
+                self.srv.warm_up_error = f"{type(e).__name__}: {e}"
+                print(f"ERROR: Backend warm up failed: {e}, retrying in {delay} s")
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
 
     def run(self):
         print("Started")
@@ -97,6 +169,13 @@ class TCPServer:
                 print("Accepted connection from", addr)
                 session = Session(conn, addr)
                 session.server = self
+                with self.sessions_lock:
+                    full = settings.admission['max_sessions'] <= len(self.sessions)
+                    if not full:
+                        self.sessions.add(session)
+                if full:
+                    self.reject_session(session)
+                    continue
                 session.thread = threading.Thread(target=self.process_connection_thread, args=(session,))
                 session.thread.daemon = True
                 session.thread.start()
@@ -104,12 +183,25 @@ class TCPServer:
                 pass
             except BaseException as e:
                 print("ERROR: Got exception:", e)
+        self.control_sock.close()
+        self.work_queue.stop()
+        self.reaper.stop()
+        self.srv.close()
+
+    def reject_session(self, session: Session):
+        # No thread is started for the session, the client gets an error right away and may retry later
+        self.admission_counters['rejected_sessions'] += 1
+        print(f"Too many sessions, rejecting {session.client_addr}")
+        try:
+            session.conn.settimeout(1)
+            session.send_packet({'status': 'error', 'exception': 'Server is busy, try again later'})
+        except OSError:
+            pass
+        session.end()
 
     def process_connection_thread(self, session: Session):
         try:
             print(f"Begin processing connection from {session.client_addr}")
-            with self.sessions_lock:
-                self.sessions.add(session)
             self.process_connection(session)
         except BaseException as e:
             print(f"ERROR: Got exception while procession connection {session.client_addr}: {e}")
@@ -119,15 +211,33 @@ class TCPServer:
             print(f"End processing connection from {session.client_addr}")
 
     def process_connection(self, session: Session):
+        self.reaper.touch(session)
+        try:
+            self.process_requests(session)
+        finally:
+            self.reaper.busy(session)
+
+    def process_requests(self, session: Session):
         while True:
             try:
                 request = session.recv_packet()
                 if request['method'] == 'end':
                     session.end()
                     break
+                if request['method'] == 'ping':
+                    # Heartbeat, answered right here: it must not wait in the queue behind real work
+                    session.send_packet({'status': 'ok', 'data': 'pong'})
+                else:
+                    self.reaper.busy(session)
+                    self.admit(request, session)
+                    deadline = self.request_deadline(request['method'])
 
-                data = self.process_request(request, session)
-                session.send_packet({'status': 'ok', 'data': data})
+                    if request.get('stream', False) and request['method'] in self.stream_methods:
+                        self.process_stream(request, session, deadline)
+                    else:
+                        future = self.submit_request(self.process_request, request, session)
+                        data = self.wait(future, request['method'], deadline)
+                        session.send_packet({'status': 'ok', 'data': data})
 
             except OSError as e:
                 logging.info('Caught ' + str(e))
@@ -136,6 +246,127 @@ class TCPServer:
             except Exception as e:
                 logging.info('Caught ' + str(e))
                 session.send_packet({'status': 'error', 'exception': str(e)})
+            self.reaper.touch(session)
+
+    def admit(self, request: dict, session: Session):
+        if not self.ip_limiter.allow(session.client_addr[0]) or \
+                (session.user_id is not None and not self.user_limiter.allow(session.user_id)):
+            self.admission_counters['rate_limited'] += 1
+            raise Rejected('Too many requests, slow down')
+
+    def method_deadline(self, method):
+        return settings.admission['deadlines'].get(method, settings.admission['default_deadline'])
+
+    # A running request can't be interrupted, so a write that missed its deadline would still be
+    # committed after the client got an error (and login would still log the session in).
+    # These are waited for as long as they take.
+    write_methods = {'create_deadline', 'change_deadline_estimate', 'change_deadline_real',
+                     'register', 'login', 'resume', 'logout'}
+
+    # Methods handled by process_request, only these are profiled: method names come from clients
+    # and become file names of the dumped profiles
+    known_methods = {'get_user_info', 'get_contingent_by_user_id', 'get_timetable', 'get_deadlines', 'get_stats',
+                     'profile', 'get_workload'} | write_methods
+
+    def request_deadline(self, method):
+        if method in self.write_methods:
+            return None
+        return time.monotonic() + self.method_deadline(method)
+
+    def submit(self, func, *args):
+        try:
+            return self.work_queue.submit(func, *args)
+        except Rejected:
+            self.admission_counters['shed'] += 1
+            raise
+
+    def submit_request(self, func, request, *args):
+        if request['method'] in self.known_methods and self.profiler.sampled(request['method']):
+            return self.submit(self.profiler.run, request['method'], request, func, request, *args)
+        return self.submit(func, request, *args)
+
+    def assert_admin(self, request: dict, session: Session):
+        # Admin methods are allowed from the server host itself or with profiling.admin_token from settings
+        token = settings.profiling['admin_token']
+        if session.client_addr[0] in ('127.0.0.1', '::1'):
+            return
+        if token is not None and hmac.compare_digest(str(request.get('token', '')), token):
+            return
+        raise Exception('Not allowed')
+
+    def wait(self, future, method, deadline):
+        # deadline None waits until the request is done (see write_methods)
+        try:
+            return future.result(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            # Not started yet: it is dropped from the queue. Already running: threads can't be interrupted,
+            # so it finishes in background and its result is thrown away. Only reads have deadlines,
+            # so nothing is changed behind the client's back.
+            future.cancel()
+            self.admission_counters['deadline_exceeded'] += 1
+            raise Exception(f'Method {method} exceeded its deadline of {self.method_deadline(method)} s')
+
+    def admission_stats(self):
+        with self.sessions_lock:
+            sessions = len(self.sessions)
+        return {**self.admission_counters, 'sessions': sessions, 'queued': self.work_queue.queue.qsize(),
+                'idle_reaped': self.reaper.reaped}
+
+    stream_methods = {'get_user_info', 'get_timetable', 'get_deadlines'}
+
+    def process_stream(self, request: dict, session: Session, deadline):
+        # Response is a sequence of {'status': 'ok', 'chunk': [...]} frames
+        # terminated by {'status': 'ok', 'end': True, 'total': N}.
+        # An error frame may come instead of the end marker.
+        # Every chunk is fetched by a worker within the request deadline, frames are sent from the session
+        # thread: a client that doesn't read its stream holds its own thread, not the workers.
+        method = request['method']
+        future = self.submit_request(self.open_stream, request, session)
+        chunks = None
+        total = 0
+        try:
+            chunks, chunk = self.wait(future, method, deadline)
+            while chunk is not None:
+                session.send_packet({'status': 'ok', 'chunk': chunk})
+                total += len(chunk)
+                future = self.submit(next, chunks, None)
+                chunk = self.wait(future, method, deadline)
+        finally:
+            # A fetch that missed the deadline may still be running, the generator (and its DB connection)
+            # can only be closed once it is done
+            future.add_done_callback(lambda f: self.close_stream(f, chunks))
+        session.send_packet({'status': 'ok', 'end': True, 'total': total})
+
+    @staticmethod
+    def close_stream(future, chunks):
+        if chunks is None and not future.cancelled() and future.exception() is None:
+            chunks = future.result()[0]
+        if chunks is not None:
+            chunks.close()
+
+    def open_stream(self, request: dict, session: Session):
+        # Runs in a worker: starts the query and fetches the first chunk, None if there are no rows
+        method = request['method']
+        time_start = request.get('time_start', None)
+        time_end = request.get('time_end', None)
+        chunk_size = request.get('chunk_size', None)
+        if chunk_size is not None:
+            chunk_size = max(1, int(chunk_size))
+
+        if method == 'get_user_info':
+            chunks = self.srv.stream_user_info(user_name=request['user_name'], chunk_size=chunk_size)
+        elif method == 'get_timetable':
+            user_id = request.get('user_id', None)
+            if user_id is None:
+                user_id = session.get_user_id()
+            chunks = self.srv.stream_timetable(user_id, time_start, time_end, chunk_size)
+        else:
+            chunks = self.srv.stream_deadlines(session.get_user_id(), time_start, time_end, chunk_size)
+        try:
+            return chunks, next(chunks, None)
+        except BaseException:
+            chunks.close()
+            raise
 
     def process_request(self, request: dict, session: Session):
         method = request['method']
@@ -156,6 +387,27 @@ class TCPServer:
             return self.srv.get_timetable(user_id, time_start, time_end)
         if method == 'get_deadlines':
             return self.srv.get_deadlines(session.get_user_id(), time_start, time_end)
+        if method == 'get_stats':
+            return {**self.srv.get_stats(), 'admission': self.admission_stats()}
+        if method == 'profile':
+            self.assert_admin(request, session)
+            action = request.get('action', 'status')
+            if action == 'start':
+                self.profiler.start(request.get('methods', None), request.get('percent', None))
+            elif action == 'stop':
+                self.profiler.stop()
+            elif action == 'reset':
+                self.profiler.reset()
+            elif action == 'dump':
+                return self.profiler.dump()
+            elif action != 'status':
+                raise Exception('Unknown profile action ' + str(action))
+            return self.profiler.status()
+        if method == 'get_workload':
+            weeks = request.get('weeks', None)
+            if weeks is not None:
+                weeks = min(max(1, int(weeks)), 52)
+            return self.srv.get_workload(session.get_user_id(), weeks)
 
         if method == 'create_deadline':
             contingent_id = request.get("contingent_id")
@@ -175,10 +427,20 @@ class TCPServer:
         elif method == 'login':
             session.assert_not_logged_in()
             session.user_id = self.srv.check_password(request['login'], request['password'])
+            session.token = self.tokens.issue(session.user_id)
             print(f'User {session.user_id} logged in')
+            return {'session_token': session.token}
+        elif method == 'resume':
+            session.assert_not_logged_in()
+            session.user_id = self.tokens.check(request['session_token'])
+            session.token = request['session_token']
+            print(f'User {session.user_id} resumed session')
         elif method == 'logout':
             id = session.get_user_id()
             session.user_id = None
+            if session.token is not None:
+                self.tokens.revoke(session.token)
+                session.token = None
             print(f'User {id} logged out')
         else:
             raise Exception('Unknown method ' + str(method))
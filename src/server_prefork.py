@@ -0,0 +1,116 @@
+import logging
+import os
+import secrets
+import signal
+import socket
+import time
+
+from src import settings
+from src.server_frontend_tcp import TCPServer, listening_socket
+
+logger = logging.getLogger(settings.logger_name)
+
+
+class Supervisor:
+    # Pre-fork mode: N worker processes, each one is a regular TCPServer with its own DB connections.
+    # Workers accept on the same port, either through SO_REUSEPORT or through one listening socket
+    # created here and inherited by fork. Crashed workers are restarted, caches are kept
+    # consistent through InvalidationBus.
+
+    def __init__(self, host: str, port: int, workers: int, reuse_port=None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        if reuse_port is None:
+            reuse_port = settings.prefork['reuse_port']
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.sock = None
+        self.children = {}
+        self.shutdown = False
+        self.started = {}
+
+    def run(self):
+        if settings.session['secret'] is None:
+            # Same secret in every worker, so that a session token from one of them is accepted by the others
+            settings.session['secret'] = secrets.token_hex(32)
+        if not self.reuse_port:
+            self.sock = listening_socket(self.host, self.port)
+        print("Supervisor", os.getpid(), "starts", self.workers, "workers on", self.host, self.port,
+              "with SO_REUSEPORT" if self.reuse_port else "with shared socket")
+
+        def term_signal_handler(sig, arg):
+            print("Supervisor got signal", sig)
+            self.stop()
+
+        def forward_signal_handler(sig, arg):
+            # Profiling signals (see TCPServer) go to every worker
+            for pid in list(self.children):
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, term_signal_handler)
+        signal.signal(signal.SIGINT, term_signal_handler)
+        signal.signal(signal.SIGUSR1, forward_signal_handler)
+        signal.signal(signal.SIGUSR2, forward_signal_handler)
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            slot = self.children.pop(pid, None)
+            if slot is None:
+                continue
+            if self.shutdown:
+                print(f"Worker {pid} exited")
+                continue
+            print(f"ERROR: Worker {pid} died with status {status}, restarting")
+            # Don't spin if a worker dies right at startup (e.g. DB is down)
+            uptime = time.monotonic() - self.started.get(slot, 0)
+            if uptime < settings.prefork['restart_delay']:
+                time.sleep(settings.prefork['restart_delay'])
+            if not self.shutdown:
+                self.spawn(slot)
+
+        if self.sock is not None:
+            self.sock.close()
+        print("Supervisor exiting")
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = slot
+            self.started[slot] = time.monotonic()
+            return
+
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # Until TCPServer sets its own handlers, default action for these would kill the worker
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            logger.info(f"Worker {slot} started with pid {os.getpid()}")
+            s = TCPServer(self.host, self.port, sock=self.sock, reuse_port=self.reuse_port, invalidation=True,
+                          worker=slot)
+            s.run()
+        except BaseException as e:
+            print(f"ERROR: Worker {slot} failed: {type(e)}: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(self):
+        self.shutdown = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
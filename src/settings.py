@@ -11,4 +11,110 @@ db_connection = {
     "passwd": "apppassword"
 }
 
+# Streaming replicas of db_connection (same keys). get_timetable, get_deadlines, get_user_info and
+# get_contingent_by_user_id read from them, everything else and reads of a user right after their own
+# writes go to the primary. For example [{**db_connection, "port": 5433}], see setup/docker-compose.replica.yml
+read_replicas = []
+
+# Replicas that are more than max_lag seconds behind are not read from, lag is checked every check_interval seconds
+replica = {
+    "max_lag": 5,
+    "check_interval": 2
+}
+
 logger_name = "app"
+
+# get_timetable reads contingent_timetable, kept up to date by the lesson loaders (see refresh_contingent_timetable()
+# in setup/schema_desc.sql). If False, lessons are joined with reference tables from the in-memory catalog
+denormalized_timetable = True
+
+# Workload analytics (get_workload, src/workload.py): weeks ahead in histograms by default and how often
+# everything is reloaded from DB in seconds, deadlines and estimates written in between are picked up incrementally
+workload = {
+    "weeks": 8,
+    "full_reload": 3600
+}
+
+# Write-behind for deadline time estimates and new deadlines (src/write_behind.py). When enabled, they are acknowledged
+# once appended and fsync'ed to the log file and written to DB in batches every flush_interval seconds or as soon as
+# batch_size changes are pending; repeated changes by one student to one deadline are written once. The log is written
+# again to DB on start after a crash. In pre-fork mode worker N writes its own log, write_behind.N.log
+write_behind = {
+    "enabled": False,
+    "log": "write_behind.log",
+    "flush_interval": 1.0,
+    "batch_size": 500
+}
+
+# On-demand profiling (src/profiling.py), off until switched on with the 'profile' method or SIGUSR1 (SIGUSR2 dumps).
+# percent of requests to methods (all if empty) run under cProfile, keep_slowest of them are dumped with their
+# profiles. 'profile' is accepted from localhost or with admin_token
+profiling = {
+    "directory": "profiles",
+    "percent": 10,
+    "methods": [],
+    "keep_slowest": 20,
+    "admin_token": None
+}
+
+# Rows per frame for streamed responses (see 'stream' flag in requests)
+stream_chunk_size = 500
+
+# Idle DB connections kept for streamed responses, per primary or replica
+stream_pool_size = 4
+
+# RUZ loader pipeline (src/lms_pipeline.py): workers per stage and queue bounds
+lms_pipeline = {
+    "fetch_workers": 4,
+    "normalize_workers": 2,
+    "write_workers": 1,
+    "queue_size": 64,
+    "link_batch_size": 32
+}
+
+# RUZ searches that found nothing are not repeated for ttl seconds (src/cache.py)
+negative_cache = {
+    "max_size": 10000,
+    "ttl": 600
+}
+
+# Pre-fork mode (./server.py --workers N), see src/server_prefork.py
+prefork = {
+    "workers": 1,
+    "reuse_port": True,
+    "restart_delay": 1.0
+}
+
+# Entries in the memoized transliteration cache of the RUZ loaders (distinct name parts)
+normalize_cache_size = 65536
+
+# Postgres NOTIFY channel used by server processes to invalidate each other's caches
+invalidation_channel = "app_invalidate"
+
+# Overload protection in the frontend (src/admission.py): session cap, token buckets per user and per client ip
+# (requests per second and burst), worker pool with a bounded queue, execution deadline per method in seconds
+admission = {
+    "max_sessions": 512,
+    "user_rate": 5,
+    "user_burst": 20,
+    "ip_rate": 20,
+    "ip_burst": 60,
+    "workers": 16,
+    "queue_size": 64,
+    "default_deadline": 10,
+    "deadlines": {
+        "get_timetable": 60,
+        "get_user_info": 30
+    }
+}
+
+# Connections that sent nothing (requests or pings) for idle_timeout seconds are closed,
+# a packet must be received completely within packet_timeout. resume_ttl is how long a client
+# may resume its login after reconnect; secret signs resume tokens, generated at startup if None
+session = {
+    "idle_timeout": 60,
+    "packet_timeout": 15,
+    "reaper_tick": 1,
+    "resume_ttl": 12 * 3600,
+    "secret": None
+}
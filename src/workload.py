@@ -0,0 +1,269 @@
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+WEEK = 7 * 24 * 3600
+EPOCH = datetime(1970, 1, 1)
+
+
+class Columns:
+    # Rows of one table as a 2d float array sorted by the id in column 0, one column per field
+    def __init__(self, names, rows=None):
+        self.names = names
+        self.data = np.empty((0, len(names)))
+        if rows is not None:
+            self.replace(rows)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        return self.data[:, self.names.index(name)]
+
+    @staticmethod
+    def _array(rows, width):
+        return np.array(rows, dtype=np.float64).reshape(-1, width)
+
+    def replace(self, rows):
+        data = self._array(rows, len(self.names))
+        self.data = data[np.argsort(data[:, 0], kind='stable')]
+
+    def upsert(self, rows):
+        new = self._array(rows, len(self.names))
+        if len(new) == 0:
+            return
+        pos = np.searchsorted(self.data[:, 0], new[:, 0])
+        found = pos < len(self.data)
+        found[found] = self.data[pos[found], 0] == new[found, 0]
+        self.data[pos[found]] = new[found]
+        if not found.all():
+            self.data = np.concatenate([self.data, new[~found]])
+            self.data = self.data[np.argsort(self.data[:, 0], kind='stable')]
+
+
+class Index:
+    # Groups values (row numbers by default) by key: get(keys) returns values of all rows with these keys
+    def __init__(self, keys, values=None):
+        order = np.argsort(keys, kind='stable')
+        self.keys = np.asarray(keys)[order]
+        self.values = order if values is None else np.asarray(values)[order]
+
+    def get(self, keys):
+        keys = np.asarray(keys)
+        begin = np.searchsorted(self.keys, keys, side='left')
+        end = np.searchsorted(self.keys, keys, side='right')
+        if len(keys) == 1:
+            return self.values[begin[0]:end[0]]
+        return np.concatenate([self.values[b:e] for b, e in zip(begin, end)] or [self.values[:0]])
+
+
+class WorkloadAnalytics:
+    # deadlines, task_time and students_to_contingents are kept in memory as NumPy columns.
+    # Rows written since the last request are reloaded by id (see written()), everything is
+    # reloaded every full_reload seconds to pick up deletes and anything missed.
+
+    def __init__(self, weeks, full_reload):
+        self.weeks = weeks
+        self.full_reload = full_reload
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.deadlines = Columns(['id', 'contingent_id', 'course_id', 'time'])
+        self.tasks = Columns(['id', 'student_id', 'deadline_id', 'estimated', 'real'])
+        self.memberships = np.empty((0, 2), dtype=np.int64)
+        self.pending = {'deadlines': set(), 'task_time': set(), 'students_to_contingents': set()}
+        self.reloads = {'full': 0, 'incremental': 0}
+        self.derived = None
+
+    def written(self, table, ids=None):
+        # ids None means the whole table may have changed
+        if table not in self.pending:
+            return
+        with self.lock:
+            if ids is None or self.pending[table] is None:
+                self.pending[table] = None
+            else:
+                self.pending[table].update(ids)
+
+    @staticmethod
+    def _deadline_rows(db, where='', params=()):
+        return db.query_formatted(f"""select id, contingent_id, coalesce(course_id, -1),
+                                             extract(epoch from deadline_time)::float8
+                                      from deadlines {where}""", params).getresult()
+
+    @staticmethod
+    def _task_rows(db, where='', params=()):
+        return db.query_formatted(f"""select id, coalesce(student_id, -1), deadline_id,
+                                             extract(epoch from estimated_time)::float8 / 3600,
+                                             coalesce(extract(epoch from real_time)::float8 / 3600, 'NaN')
+                                      from task_time {where}""", params).getresult()
+
+    def refresh(self, db):
+        with self.lock:
+            pending = self.pending
+            self.pending = {table: set() for table in pending}
+        stale = self.loaded is None or self.loaded + self.full_reload < time.monotonic()
+        if not stale and all(ids is not None and len(ids) == 0 for ids in pending.values()):
+            return
+        self.derived = None
+        try:
+            if stale:
+                self.deadlines.replace(self._deadline_rows(db))
+                self.tasks.replace(self._task_rows(db))
+                self._load_memberships(db)
+                self.loaded = time.monotonic()
+                self.reloads['full'] += 1
+                logger.info(f"Workload analytics loaded: {len(self.deadlines)} deadlines, {len(self.tasks)} tasks")
+                return
+            self.reloads['incremental'] += 1
+            if pending['deadlines'] is None:
+                self.deadlines.replace(self._deadline_rows(db))
+            elif len(pending['deadlines']) != 0:
+                self.deadlines.upsert(self._deadline_rows(db, "where id = any(%s::bigint[])",
+                                                          (list(pending['deadlines']),)))
+            if pending['task_time'] is None:
+                self.tasks.replace(self._task_rows(db))
+            elif len(pending['task_time']) != 0:
+                self.tasks.upsert(self._task_rows(db, "where id = any(%s::bigint[])", (list(pending['task_time']),)))
+            if pending['students_to_contingents'] is None or len(pending['students_to_contingents']) != 0:
+                self._load_memberships(db)
+        except BaseException:
+            # Nothing is lost, the same rows are reloaded next time
+            with self.lock:
+                for table, ids in pending.items():
+                    if ids is None or self.pending[table] is None:
+                        self.pending[table] = None
+                    else:
+                        self.pending[table].update(ids)
+            raise
+
+    def _load_memberships(self, db):
+        rows = db.query("select student_id, contingent_id from students_to_contingents").getresult()
+        self.memberships = np.array(rows, dtype=np.int64).reshape(-1, 2)
+
+    def _task_deadlines(self):
+        # Index of each task's deadline in self.deadlines, -1 if it is not loaded
+        deadline_ids, wanted = self.deadlines['id'], self.tasks['deadline_id']
+        if len(deadline_ids) == 0:
+            return np.full(len(wanted), -1, dtype=np.int64)
+        pos = np.searchsorted(deadline_ids, wanted)
+        pos[pos == len(deadline_ids)] = 0
+        return np.where(deadline_ids[pos] == wanted, pos, -1)
+
+    def _derive(self):
+        # Values shared by all students and indexes by student and contingent, so that a request
+        # only touches rows of its own contingents. Recomputed only after a refresh changed something.
+        if self.derived is None:
+            n = len(self.deadlines)
+            task_deadline = self._task_deadlines()
+            linked = task_deadline >= 0
+            # Mean estimate of every deadline over everybody who gave one
+            estimate_sum = np.bincount(task_deadline[linked], weights=self.tasks['estimated'][linked], minlength=n)
+            estimate_count = np.bincount(task_deadline[linked], minlength=n)
+            group_hours = np.divide(estimate_sum, estimate_count, out=np.zeros(n), where=estimate_count > 0)
+
+            linked_tasks = np.flatnonzero(linked)
+            task_contingent = self.deadlines['contingent_id'][task_deadline[linked_tasks]]
+            self.derived = {
+                'task_deadline': task_deadline,
+                'group_hours': group_hours,
+                'tasks_by_student': Index(self.tasks['student_id']),
+                'tasks_by_contingent': Index(task_contingent, linked_tasks),
+                'deadlines_by_contingent': Index(self.deadlines['contingent_id']),
+                'contingents_by_student': Index(self.memberships[:, 0], self.memberships[:, 1]),
+            }
+        return self.derived
+
+    @staticmethod
+    def _accuracy(estimated, real):
+        done = ~np.isnan(real)
+        estimated, real = estimated[done], real[done]
+        total_estimated, total_real = float(estimated.sum()), float(real.sum())
+        return {'tasks': int(done.sum()),
+                'estimated_hours': round(total_estimated, 2),
+                'real_hours': round(total_real, 2),
+                'overrun': round(total_real / total_estimated, 3) if total_estimated > 0 else None,
+                'mean_error_hours': round(float(np.abs(real - estimated).mean()), 2) if len(real) else None,
+                'underestimated_share': round(float((real > estimated).mean()), 3) if len(real) else None}
+
+    def student(self, student_id, weeks=None, today=None):
+        weeks = weeks or self.weeks
+        today = today or date.today()
+        monday = datetime.combine(today - timedelta(days=today.weekday()), datetime.min.time())
+        derived = self._derive()
+        task_deadline, group_hours = derived['task_deadline'], derived['group_hours']
+        estimated, real = self.tasks['estimated'], self.tasks['real']
+
+        contingents = np.unique(derived['contingents_by_student'].get([student_id]))
+        # Deadlines of the student's contingents, sorted, and which contingent each of them belongs to
+        visible = np.sort(derived['deadlines_by_contingent'].get(contingents))
+        contingent_index = np.searchsorted(contingents, self.deadlines['contingent_id'][visible])
+
+        # Own estimate where there is one, the group's otherwise
+        hours = group_hours[visible]
+        own = derived['tasks_by_student'].get([student_id])
+        own_deadline = task_deadline[own]
+        pos = np.searchsorted(visible, own_deadline)
+        pos[pos == len(visible)] = 0
+        mine = (own_deadline >= 0) & (len(visible) != 0)
+        mine[mine] = visible[pos[mine]] == own_deadline[mine]
+        hours[pos[mine]] = estimated[own[mine]]
+
+        # deadline_time is timestamp without time zone, its epoch is counted as if it was UTC
+        week = np.floor((self.deadlines['time'][visible] - (monday - EPOCH).total_seconds()) / WEEK).astype(np.int64)
+        in_range = (0 <= week) & (week < weeks)
+
+        week_rows = []
+        deadline_counts = np.bincount(week[in_range], minlength=weeks)
+        own_hist = np.bincount(week[in_range], weights=hours[in_range], minlength=weeks)
+        group_hist = np.bincount(week[in_range], weights=group_hours[visible][in_range], minlength=weeks)
+        for i in range(weeks):
+            week_rows.append({'week_start': str((monday + timedelta(weeks=i)).date()),
+                              'deadlines': int(deadline_counts[i]),
+                              'hours': round(float(own_hist[i]), 2),
+                              'group_hours': round(float(group_hist[i]), 2)})
+
+        # Per contingent: weekly hours by group estimates and accuracy of everybody's estimates
+        cells = contingent_index[in_range] * weeks + week[in_range]
+        contingent_hist = np.bincount(cells, weights=group_hours[visible][in_range],
+                                      minlength=len(contingents) * weeks).reshape(-1, weeks)
+        contingent_rows = []
+        for i, contingent_id in enumerate(contingents):
+            tasks = derived['tasks_by_contingent'].get([contingent_id])
+            contingent_rows.append({'contingent_id': int(contingent_id),
+                                    'weekly_hours': [round(float(h), 2) for h in contingent_hist[i]],
+                                    'accuracy': self._accuracy(estimated[tasks], real[tasks])})
+
+        # Per course overrun over all finished tasks of the student's contingents
+        tasks = derived['tasks_by_contingent'].get(contingents)
+        tasks = tasks[~np.isnan(real[tasks])]
+        courses, course_index = np.unique(self.deadlines['course_id'][task_deadline[tasks]].astype(np.int64),
+                                          return_inverse=True)
+        course_estimated = np.bincount(course_index, weights=estimated[tasks], minlength=len(courses))
+        course_real = np.bincount(course_index, weights=real[tasks], minlength=len(courses))
+        course_tasks = np.bincount(course_index, minlength=len(courses))
+        course_rows = []
+        for i, course_id in enumerate(courses):
+            if course_id < 0:
+                continue
+            course_rows.append({'course_id': int(course_id),
+                                'tasks': int(course_tasks[i]),
+                                'estimated_hours': round(float(course_estimated[i]), 2),
+                                'real_hours': round(float(course_real[i]), 2),
+                                'overrun': round(float(course_real[i] / course_estimated[i]), 3)
+                                if course_estimated[i] > 0 else None})
+
+        return {'weeks': week_rows,
+                'accuracy': self._accuracy(estimated[own], real[own]),
+                'contingents': contingent_rows,
+                'courses': course_rows}
+
+    def stats(self):
+        return {'deadlines': len(self.deadlines), 'tasks': len(self.tasks), 'memberships': len(self.memberships),
+                **self.reloads}
@@ -0,0 +1,387 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+import pg
+
+import src.settings as settings
+
+logger = logging.getLogger(settings.logger_name)
+
+
+class WriteAheadLog:
+    # Append-only file of JSON lines. add() only buffers a record, wait() returns once it is on disk.
+    # Threads waiting at the same time share one write and fsync (group commit): the first of them
+    # writes everything buffered so far, the others wait for it.
+    # rotate() closes the current file as a numbered segment, segments are deleted once their records are in DB.
+
+    def __init__(self, path):
+        self.path = path
+        self.cond = threading.Condition()
+        self.buffer = []
+        self.added = 0
+        self.synced = 0
+        self.syncing = False
+        self.fsyncs = 0
+        self.next_segment = 1 + max([self.segment_number(p) for p in self.segments()] or [0])
+        self.file = open(self.path, 'a')
+
+    def segments(self):
+        paths = [p for p in glob.glob(glob.escape(self.path) + '.*') if p.rsplit('.', 1)[1].isdigit()]
+        return sorted(paths, key=self.segment_number)
+
+    @staticmethod
+    def segment_number(path):
+        return int(path.rsplit('.', 1)[1])
+
+    def read(self):
+        # Records of all segments and the current file in write order. A crash may leave
+        # the last line cut short, such a record was never acknowledged and is skipped.
+        records = []
+        for path in self.segments() + [self.path]:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning(f"Skipping broken record in {path}: {line!r}")
+        return records
+
+    def add(self, record):
+        with self.cond:
+            self.buffer.append(json.dumps(record, default=str) + '\n')
+            self.added += 1
+            return self.added
+
+    def wait(self, ticket):
+        with self.cond:
+            while self.synced < ticket:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                lines, self.buffer = self.buffer, []
+                last = self.added
+                file = self.file
+                self.syncing = True
+                self.cond.release()
+                try:
+                    self._write(file, lines)
+                except BaseException:
+                    self.cond.acquire()
+                    self.buffer = lines + self.buffer
+                    self.syncing = False
+                    self.cond.notify_all()
+                    raise
+                self.cond.acquire()
+                self.synced = last
+                self.syncing = False
+                self.cond.notify_all()
+
+    def _write(self, file, lines):
+        file.write(''.join(lines))
+        file.flush()
+        os.fsync(file.fileno())
+        self.fsyncs += 1
+
+    def rotate(self):
+        # Everything added so far goes to the returned segment, later records to a new file
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            self._write(self.file, self.buffer)
+            self.buffer = []
+            self.synced = self.added
+            self.cond.notify_all()
+            self.file.close()
+            segment = f"{self.path}.{self.next_segment}"
+            self.next_segment += 1
+            os.rename(self.path, segment)
+            self.file = open(self.path, 'a')
+            return segment
+
+    def close(self):
+        with self.cond:
+            self.file.close()
+
+
+class WriteBehind:
+    # Deadline time estimates and new deadlines are acknowledged as soon as they are in the log and
+    # written to DB in batches by a background thread. Repeated updates of the same (student, deadline)
+    # are merged, only the last estimate and the last real time are written. Whatever is left in
+    # the log after a crash is loaded back on start and written with the first batch.
+
+    def __init__(self, connect, path, flush_interval, batch_size, on_flush=None):
+        self.connect = connect
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self._db = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.times = {}
+        self.deadlines = {}
+        self.in_flight = {}
+        self.in_flight_deadlines = {}
+        self.dead_letter = path + '.rejected'
+        self.counters = {'acknowledged': 0, 'batches': 0, 'written': 0, 'dropped': 0, 'failed_batches': 0}
+
+        self.log = WriteAheadLog(path)
+        for record in self.log.read():
+            self._apply(record)
+        self.counters['replayed'] = self.pending
+        # Segments whose records are in self.times and self.deadlines but not in DB yet
+        self.unflushed = self.log.segments() + [self.log.rotate()]
+        if self.pending:
+            logger.info(f"Write-behind log has {self.pending} unwritten changes, writing them with next batch")
+        else:
+            self._remove_unflushed()
+
+        self.thread = threading.Thread(target=self.run, name='write-behind')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = self.connect()
+        return self._db
+
+    def _apply(self, record):
+        if record['op'] == 'deadline':
+            self.deadlines[record['id']] = record
+        else:
+            key = (record['student_id'], record['deadline_id'])
+            times = self.times.setdefault(key, {'estimated': None, 'real': None})
+            times[record['op']] = record['val']
+
+    def _append(self, record):
+        with self.lock:
+            self._apply(record)
+            ticket = self.log.add(record)
+            pending = len(self.times) + len(self.deadlines)
+        self.log.wait(ticket)
+        self.counters['acknowledged'] += 1
+        if self.batch_size <= pending:
+            self.wakeup.set()
+
+    def set_estimate(self, student_id, deadline_id, hours):
+        self._append({'op': 'estimated', 'student_id': student_id, 'deadline_id': deadline_id, 'val': hours})
+
+    def set_real(self, student_id, deadline_id, hours):
+        self._append({'op': 'real', 'student_id': student_id, 'deadline_id': deadline_id, 'val': hours})
+
+    def create_deadline(self, deadline_id, user_id, contingent_id, time, weight, name, desc):
+        self._append({'op': 'deadline', 'id': deadline_id, 'user_id': user_id, 'contingent_id': contingent_id,
+                      'time': time, 'weight': weight, 'name': name, 'desc': desc})
+
+    def has_estimate(self, student_id, deadline_id):
+        # Pending or being written right now: the latter is not visible in DB until its batch commits
+        with self.lock:
+            for pending in (self.times, self.in_flight):
+                times = pending.get((student_id, deadline_id))
+                if times is not None and times['estimated'] is not None:
+                    return True
+            return False
+
+    def has_deadline(self, deadline_id):
+        # Created through write-behind and not committed yet
+        with self.lock:
+            return deadline_id in self.deadlines or deadline_id in self.in_flight_deadlines
+
+    @property
+    def pending(self):
+        return len(self.times) + len(self.deadlines)
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Write-behind flush failed, will retry: {type(e)}: {e}")
+
+    def flush(self):
+        # Also called before reads that have to see pending values. Nothing pending is checked under flush_lock:
+        # a batch another thread is writing right now is not pending any more, but the read must wait for it too
+        with self.flush_lock:
+            if self.pending == 0:
+                return
+            with self.lock:
+                times, self.times = self.times, {}
+                deadlines, self.deadlines = self.deadlines, {}
+                # Being written: not pending any more, not in DB yet (see has_estimate)
+                self.in_flight = times
+                self.in_flight_deadlines = deadlines
+                self.unflushed.append(self.log.rotate())
+            try:
+                if len(times) != 0 or len(deadlines) != 0:
+                    self._flush(deadlines, times)
+            finally:
+                with self.lock:
+                    self.in_flight = {}
+                    self.in_flight_deadlines = {}
+
+    def _flush(self, deadlines, times):
+        # Segments are removed only when every record of the batch is either committed or in the dead letter file.
+        # If writing stops halfway, the rest goes back to pending and the segments stay: replaying records
+        # that are already in DB writes the same values again.
+        written = {'deadlines': {}, 'times': {}, 'rejected': set()}
+        try:
+            try:
+                self._write_batch(deadlines, times, written)
+            except (pg.IntegrityError, pg.DataError) as e:
+                # Some record can't be written at all, find it instead of failing the whole batch forever
+                logger.warning(f"Write-behind batch failed, writing records one by one: {e}")
+                self.counters['failed_batches'] += 1
+                self._write_one_by_one(deadlines, times, written)
+        except BaseException:
+            self.counters['failed_batches'] += 1
+            done = set(written['deadlines']) | set(written['times']) | written['rejected']
+            self._restore({id: d for id, d in deadlines.items() if id not in done},
+                          {key: t for key, t in times.items() if key not in done})
+            self._reset_connection()
+            self._notify(deadlines, times, written)
+            raise
+        self._remove_unflushed()
+        self.counters['batches'] += 1
+        self._notify(deadlines, times, written)
+
+    def _restore(self, deadlines, times):
+        with self.lock:
+            # Newer values that arrived meanwhile win
+            for key, value in times.items():
+                merged = dict(value)
+                merged.update({k: v for k, v in self.times.get(key, {}).items() if v is not None})
+                self.times[key] = merged
+            self.deadlines = {**deadlines, **self.deadlines}
+
+    def _notify(self, deadlines, times, written):
+        if len(written['deadlines']) == 0 and len(written['times']) == 0:
+            return
+        self.counters['written'] += len(written['deadlines']) + len(written['times'])
+        if self.on_flush is None:
+            return
+        task_ids = [id for ids in written['times'].values() for id in ids]
+        users = {student_id for student_id, _ in written['times']} | \
+                {deadlines[id]['user_id'] for id in written['deadlines']}
+        try:
+            self.on_flush(self.db, list(written['deadlines']), task_ids, users)
+        except Exception as e:
+            logger.warning(f"Write-behind flush notification failed: {type(e)}: {e}")
+
+    def _remove_unflushed(self):
+        for segment in self.unflushed:
+            os.remove(segment)
+        self.unflushed = []
+
+    def _reset_connection(self):
+        if self._db is not None:
+            try:
+                self._db.close()
+            except pg.Error:
+                pass
+            self._db = None
+
+    def _write_batch(self, deadlines, times, written):
+        # Committed records go to written: deadline ids and task_time ids by (student, deadline)
+        db = self.db
+        db.begin()
+        try:
+            self._insert_deadlines(db, list(deadlines.values()))
+            task_ids = self._write_times(db, times)
+            db.end()
+        except BaseException:
+            db.rollback()
+            raise
+        written['deadlines'].update(dict.fromkeys(deadlines))
+        for key, id in task_ids:
+            written['times'].setdefault(key, []).append(id)
+        for key in times:
+            written['times'].setdefault(key, [])
+
+    def _write_one_by_one(self, deadlines, times, written):
+        units = [({id: deadline}, {}) for id, deadline in deadlines.items()] + \
+                [({}, {key: value}) for key, value in times.items()]
+        for unit_deadlines, unit_times in units:
+            try:
+                self._write_batch(unit_deadlines, unit_times, written)
+            except (pg.IntegrityError, pg.DataError) as e:
+                self._reject(unit_deadlines, unit_times, e)
+                # Not written, but not to be retried either
+                written['rejected'].update(unit_deadlines, unit_times)
+
+    def _reject(self, deadlines, times, error):
+        # Acknowledged changes DB refuses are kept in the dead letter file to be fixed by hand
+        records = list(deadlines.values()) + [{'op': 'times', 'student_id': student_id, 'deadline_id': deadline_id,
+                                               **value} for (student_id, deadline_id), value in times.items()]
+        logger.error(f"Write-behind record rejected by DB, moved to {self.dead_letter}: {records}: {error}")
+        with open(self.dead_letter, 'a') as f:
+            for record in records:
+                f.write(json.dumps({'record': record, 'error': str(error), 'time': time.time()}, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.counters['dropped'] += len(records)
+
+    @staticmethod
+    def _insert_deadlines(db, deadlines):
+        if len(deadlines) == 0:
+            return
+        # Explicit ids were reserved with nextval() when the deadline was acknowledged,
+        # a record replayed after it was already written is skipped by the conflict clause
+        db.query_formatted("""
+            insert into deadlines (id, deadline_time, weight, deadline_name, description, contingent_id, course_id)
+            select d.id, d.time, d.weight, d.name, d.description, d.contingent_id,
+                   (select course_id from lesson where lesson.contingent_id = d.contingent_id limit 1)
+            from unnest(%s::bigint[], %s::timestamp[], %s::float8[], %s::text[], %s::text[], %s::bigint[])
+                   as d(id, time, weight, name, description, contingent_id)
+            on conflict (id) do nothing""",
+                           ([d['id'] for d in deadlines], [d['time'] for d in deadlines],
+                            [d['weight'] for d in deadlines], [d['name'] for d in deadlines],
+                            [d['desc'] for d in deadlines], [d['contingent_id'] for d in deadlines]))
+
+    @staticmethod
+    def _write_times(db, times):
+        if len(times) == 0:
+            return []
+        columns = ([key[0] for key in times], [key[1] for key in times],
+                   [value['estimated'] for value in times.values()], [value['real'] for value in times.values()])
+        values = """unnest(%s::bigint[], %s::bigint[], %s::float8[], %s::float8[])
+                      as v(student_id, deadline_id, estimated, real)"""
+        updated = db.query_formatted(f"""
+            update task_time t
+            set estimated_time = coalesce(v.estimated * interval '1 hour', t.estimated_time),
+                real_time = coalesce(v.real * interval '1 hour', t.real_time)
+            from {values}
+            where t.student_id = v.student_id and t.deadline_id = v.deadline_id
+            returning t.student_id, t.deadline_id, t.id""", columns).getresult()
+        # Real time without an estimate was refused when it was acknowledged, so such rows always exist
+        inserted = db.query_formatted(f"""
+            insert into task_time (student_id, deadline_id, estimated_time, real_time)
+            select v.student_id, v.deadline_id, v.estimated * interval '1 hour', v.real * interval '1 hour'
+            from {values}
+            where v.estimated is not null
+              and not exists (select 1 from task_time t
+                              where t.student_id = v.student_id and t.deadline_id = v.deadline_id)
+            returning student_id, deadline_id, id""", columns).getresult()
+        return [((student_id, deadline_id), id) for student_id, deadline_id, id in updated + inserted]
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning(f"Could not write pending changes on shutdown, they stay in the log: {e}")
+        self.log.close()
+        self._reset_connection()
+
+    def stats(self):
+        return {**self.counters, 'pending': self.pending, 'fsyncs': self.log.fsyncs}